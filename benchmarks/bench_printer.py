@@ -0,0 +1,74 @@
+"""
+Measures content classification (json, markdown or regular text) and -e
+extraction, at once and streamed in 16 character deltas, of the printer on
+large and pathological outputs
+
+usage: python benchmarks/bench_printer.py [--size 1000000]
+"""
+
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from chatblade import printer  # noqa: E402
+
+
+def inputs(size):
+    words = "lorem ipsum dolor sit amet consectetur adipiscing elit "
+    line = (words * (size // len(words) + 1))[:size]
+    markdown = "Some **bold** text with `code` and a [link](https://example.com)\n\n"
+    code = "```python\nprint('hello')\n```\n\n"
+    return {
+        "single line prose": line,
+        "single line json": json.dumps(line.split()[: size // 8]),
+        "markdown": ((markdown + code) * (size // len(markdown + code) + 1))[:size],
+        "open brackets": "[" * size,
+        "brace lines": "{ x = 1 }\n" * (size // 10),
+        "open brace lines": "{\n" * (size // 2),
+        "nested lines": "[\n" * (size // 2),
+        "bold markers": " **a" * (size // 4),
+        "underscores": " __" * (size // 3),
+        "backticks": "`" * size,
+        "unclosed links": "[a](http://" * (size // 11),
+        "json after prose": "here you go:\n" + json.dumps({"k": line[: size // 2]}),
+    }
+
+
+def extract_streamed(text, delta_size=16):
+    extractor = printer.JsonExtractor()
+    for i in range(0, len(text), delta_size):
+        extractor.feed(text[i : i + delta_size])
+    extractor.close()
+
+
+def bench(size, repeat):
+    print(f"{'input':>20} {'classify':>12} {'extract':>12} {'streamed':>12}  kind")
+    for name, text in inputs(size).items():
+        classify = min(
+            timeit.repeat(lambda: printer.classify(text), number=1, repeat=repeat)
+        )
+        extract = min(
+            timeit.repeat(
+                lambda: printer.extract_content(text), number=1, repeat=repeat
+            )
+        )
+        streamed = min(
+            timeit.repeat(lambda: extract_streamed(text), number=1, repeat=repeat)
+        )
+        kind = printer.classify(text).kind
+        print(
+            f"{name:>20} {classify * 1000:>10.2f}ms {extract * 1000:>10.2f}ms"
+            f" {streamed * 1000:>10.2f}ms  {kind}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    bench(args.size, args.repeat)
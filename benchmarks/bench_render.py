@@ -0,0 +1,101 @@
+"""
+Measures the cost of rendering a streamed response to the terminal:
+the time spent per delta by printer.StreamPrinter when it redraws on every
+delta, and the cost of its last frame compared to redrawing the full
+response
+
+usage: python benchmarks/bench_render.py [--sizes 1000 10000 100000]
+"""
+
+import argparse
+import io
+import os
+import random
+import sys
+import time
+
+from rich.console import Console
+from rich.live import Live
+from rich.text import Text
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from chatblade import printer, utils  # noqa: E402
+
+
+def synthetic_response(size, seed=0):
+    """markdown-ish text of about size characters, with paragraphs,
+    lists and code blocks"""
+    rnd = random.Random(seed)
+    words = ["stream", "token", "render", "**bold**", "`code`", "the", "a", "of"]
+    parts = []
+    length = 0
+    while length < size:
+        kind = rnd.random()
+        if kind < 0.2:
+            lines = [f"    value_{i} = compute({i})" for i in range(rnd.randint(3, 30))]
+            part = "```python\ndef f():\n" + "\n".join(lines) + "\n```"
+        elif kind < 0.35:
+            part = "\n".join(f"- {rnd.choice(words)} item" for _ in range(5))
+        else:
+            part = " ".join(rnd.choices(words, k=rnd.randint(20, 80)))
+        parts.append(part)
+        length += len(part) + 2
+    return "\n\n".join(parts)
+
+
+def deltas(text, rnd):
+    pos = 0
+    while pos < len(text):
+        step = rnd.randint(1, 8)
+        yield text[pos : pos + step]
+        pos += step
+
+
+def terminal():
+    return Console(file=io.StringIO(), force_terminal=True, width=100, height=40)
+
+
+def bench_stream_printer(text):
+    printer.console = terminal()
+    args = utils.DotDict(raw=False, no_format=True, theme=None)
+    start = time.perf_counter()
+    with printer.StreamPrinter(args, refresh_per_second=1e9) as stream_printer:
+        for delta in deltas(text, random.Random(1)):
+            stream_printer.update(delta)
+        total = time.perf_counter() - start
+        frame_start = time.perf_counter()
+        stream_printer.update(" ")
+        frame = time.perf_counter() - frame_start
+    return total / stream_printer.deltas, frame
+
+
+def bench_full_redraw(text):
+    """one frame of the previous approach, redrawing the whole response"""
+    console = terminal()
+    with Live(
+        Text(""), console=console, auto_refresh=False, vertical_overflow="visible"
+    ) as live:
+        start = time.perf_counter()
+        live.update(text, refresh=True)
+        return time.perf_counter() - start
+
+
+def bench(sizes):
+    columns = ["chars", "us/delta", "frame", "full frame"]
+    print(" ".join(f"{c:>12}" for c in columns))
+    for size in sizes:
+        text = synthetic_response(size)
+        per_delta, frame = bench_stream_printer(text)
+        full_frame = bench_full_redraw(text)
+        print(
+            f"{size:>12} {per_delta * 1e6:>10.1f}us {frame * 1000:>10.2f}ms "
+            f"{full_frame * 1000:>10.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    args = parser.parse_args()
+    bench(args.sizes)
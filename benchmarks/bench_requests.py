@@ -0,0 +1,124 @@
+"""
+Measures the request path of chatblade against the local stub server
+(chatblade.stubserver): the time to the first token and the streaming
+overhead on top of the server's own latency, retries of rate limited
+requests and concurrent unstreamed requests, as run by --batch and
+--map-reduce
+
+usage: python benchmarks/bench_requests.py [--ttft 0.1] [--token-delay 0.001]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from chatblade import chat, ratelimit, stubserver, utils  # noqa: E402
+
+
+def start_server(*args):
+    options = stubserver.build_parser().parse_args(list(args))
+    server = stubserver.make_server(options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def config(server, **kwargs):
+    return utils.DotDict(
+        openai_base_url=f"http://127.0.0.1:{server.server_port}/v1",
+        openai_api_key="stub",
+        model="gpt-4o",
+        retries=10,
+        **kwargs,
+    )
+
+
+def query(text):
+    return chat.init_conversation(text)
+
+
+def bench_stream(ttft, token_delay, tokens, repeat):
+    server = start_server(
+        "--ttft", str(ttft), "--token-delay", str(token_delay), "--tokens", str(tokens)
+    )
+    params = config(server, stream=True)
+    chat.query_chat_gpt(query("warm up"), params).message
+    firsts, totals = [], []
+    for i in range(repeat):
+        start = time.perf_counter()
+        stream = chat.query_chat_gpt(query(f"stream {i}"), params)
+        for n, _ in enumerate(stream):
+            if not n:
+                firsts.append(time.perf_counter() - start)
+        totals.append(time.perf_counter() - start)
+    server.shutdown()
+    served = ttft + token_delay * (tokens - 1)
+    first, total = min(firsts), min(totals)
+    print(
+        f"stream      first token {first * 1000:8.1f}ms (+{(first - ttft) * 1000:.1f}ms)"
+        f"  complete {total * 1000:8.1f}ms (+{(total - served) * 1000:.1f}ms)"
+    )
+
+
+def bench_retries(rate, count):
+    server = start_server(
+        "--ttft", "0", "--token-delay", "0", "--tokens", "10",
+        "--rate-limit-rate", str(rate), "--retry-after", "0",
+    )  # fmt: skip
+    params = config(server, stream=False)
+    start = time.perf_counter()
+    for i in range(count):
+        chat.query_chat_gpt(query(f"retry {i}"), params)
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    print(
+        f"retries     {count} queries, {server.requests - count} rate limited"
+        f" requests, {elapsed / count * 1000:.1f}ms per query"
+    )
+
+
+def bench_concurrency(ttft, token_delay, tokens, count, concurrency):
+    server = start_server(
+        "--ttft", str(ttft), "--token-delay", str(token_delay), "--tokens", str(tokens)
+    )
+    params = config(server, stream=False)
+
+    async def run():
+        slots = asyncio.Semaphore(concurrency)
+
+        async def ask(i):
+            async with slots:
+                await chat.query_chat_gpt_async(query(f"concurrent {i}"), params)
+
+        await asyncio.gather(*(ask(i) for i in range(count)))
+
+    start = time.perf_counter()
+    asyncio.run(run())
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    # the server time of all the queries, when they fully overlap
+    ideal = (ttft + token_delay * (tokens - 1)) * -(-count // concurrency)
+    print(
+        f"concurrent  {count} queries, {concurrency} at a time, "
+        f"{elapsed * 1000:.1f}ms (+{(elapsed - ideal) * 1000:.1f}ms)"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--ttft", type=float, default=0.1)
+    parser.add_argument("--token-delay", type=float, default=0.001)
+    parser.add_argument("--tokens", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    # keep the backoff jitter on top of Retry-After from dominating
+    ratelimit.BACKOFF_BASE = 0.001
+    bench_stream(args.ttft, args.token_delay, args.tokens, args.repeat)
+    bench_retries(0.3, 20)
+    bench_concurrency(args.ttft, args.token_delay, args.tokens, 32, args.concurrency)
@@ -0,0 +1,86 @@
+"""
+Measures the startup cost of chatblade code paths that should not need the
+heavy dependencies, and fails if any of them imports one of those anyway
+
+usage: python benchmarks/bench_startup.py [--repeat 5] [--max-ms 150]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+HEAVY_MODULES = ["openai", "tiktoken", "rich", "yaml", "pylatexenc"]
+
+COMMANDS = {
+    "import cli": ["-c", "import chatblade.cli"],
+    "--version": ["-m", "chatblade", "--version"],
+    "--session-list": ["-m", "chatblade", "--session-list"],
+    "--session-path": ["-m", "chatblade", "-S", "bench", "--session-path"],
+}
+
+
+def run(args, env):
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        env=env,
+        stdin=subprocess.DEVNULL,
+        capture_output=True,
+        text=True,
+    )
+    elapsed = time.perf_counter() - start
+    return elapsed, imported_modules(proc.stderr)
+
+
+def imported_modules(importtime_output):
+    """top level package names from python -X importtime output"""
+    modules = set()
+    for line in importtime_output.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            name = line.rsplit("|", 1)[1].strip()
+            modules.add(name.split(".")[0])
+    return modules
+
+
+def bench(repeat, max_ms):
+    home = tempfile.mkdtemp()
+    os.makedirs(os.path.join(home, ".cache", "chatblade"))
+    with open(os.path.join(home, ".cache", "chatblade", "bench.jsonl"), "w") as f:
+        f.write('{"role": "user", "content": "hi"}\n')
+    env = {
+        **os.environ,
+        "HOME": home,
+        "PYTHONPATH": os.path.join(os.path.dirname(__file__), ".."),
+    }
+
+    # the first listing indexes the session, which needs tiktoken
+    run(COMMANDS["--session-list"], env)
+
+    failed = False
+    for name, args in COMMANDS.items():
+        timings = []
+        for _ in range(repeat):
+            elapsed, modules = run(args, env)
+            timings.append(elapsed)
+        best = min(timings) * 1000
+        heavy = sorted(m for m in HEAVY_MODULES if m in modules)
+        status = "ok"
+        if heavy:
+            status = "imports " + ", ".join(heavy)
+            failed = True
+        elif max_ms and best > max_ms:
+            status = f"slower than {max_ms}ms"
+            failed = True
+        print(f"{name:>16} {best:>8.1f}ms  {status}")
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-ms", type=float, help="fail above this wall time")
+    args = parser.parse_args()
+    sys.exit(1 if bench(args.repeat, args.max_ms) else 0)
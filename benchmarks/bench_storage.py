@@ -0,0 +1,77 @@
+"""
+Compares session load times across session sizes:
+the legacy yaml format with the pure python and the libyaml loader,
+a full load of the jsonl format and a load of only the last message
+
+usage: python benchmarks/bench_storage.py [--sizes 10 100 1000 10000]
+"""
+
+import argparse
+import os
+import random
+import string
+import sys
+import tempfile
+import timeit
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from chatblade import chat, storage  # noqa: E402
+
+
+def synthetic_messages(count, seed=0):
+    rnd = random.Random(seed)
+    words = ["".join(rnd.choices(string.ascii_lowercase, k=8)) for _ in range(500)]
+    roles = ["user", "assistant"]
+    return [
+        chat.Message(
+            roles[i % 2], " ".join(rnd.choices(words, k=rnd.randint(20, 400)))
+        )
+        for i in range(count)
+    ]
+
+
+def best_of(fn, repeat):
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def bench(sizes, repeat):
+    cache_dir = tempfile.mkdtemp()
+    storage.get_cache_path = lambda create=True: cache_dir
+
+    columns = ["messages", "size", "yaml", "libyaml", "jsonl", "last"]
+    print(" ".join(f"{c:>9}" for c in columns))
+    for size in sizes:
+        messages = synthetic_messages(size)
+        session = f"bench{size}"
+        storage.to_cache(messages, session)
+        yaml_path = storage.get_yaml_session_path(session)
+        with open(yaml_path, "w") as f:
+            yaml.dump([m._asdict() for m in messages], f)
+
+        def load_yaml(loader):
+            with open(yaml_path, "r") as f:
+                return [chat.Message.import_yaml(m) for m in yaml.load(f, loader)]
+
+        timings = [
+            best_of(lambda: load_yaml(yaml.SafeLoader), repeat),
+            best_of(lambda: load_yaml(storage.yaml_safe_loader()), repeat),
+            best_of(lambda: storage.messages_from_cache(session), repeat),
+            best_of(lambda: storage.last_message_from_cache(session), repeat),
+        ]
+        os.unlink(yaml_path)
+        file_size = os.path.getsize(storage.get_session_path(session))
+        print(
+            f"{size:>9} {file_size / 1024 / 1024:>8.2f}M "
+            + " ".join(f"{t * 1000:>8.2f}ms" for t in timings)
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    bench(args.sizes, args.repeat)
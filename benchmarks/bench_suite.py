@@ -0,0 +1,318 @@
+"""
+Runs the benchmarks of the hot paths offline and compares them to a stored
+baseline: token counting, session storage, message formatting and
+streaming, on synthetic sessions of 10 to 10k messages, synthetic streams
+and pathological printer inputs. Reports the time, throughput and peak
+memory (traced in a separate run, so it doesn't slow the timings) of
+every case
+
+usage: python benchmarks/bench_suite.py [--save] [--only tokens storage ...]
+       [--sizes 10 100 1000 10000] [--chars 20000]
+"""
+
+import argparse
+import collections
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from chatblade import chat, printer, storage, utils  # noqa: E402
+from bench_printer import inputs as printer_inputs  # noqa: E402
+from bench_render import deltas, synthetic_response, terminal  # noqa: E402
+from bench_storage import synthetic_messages  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+# the pre-tokenization pattern of cl100k_base
+CL100K_PATTERN = (
+    r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}+|\p{N}{1,3}|"""
+    r""" ?[^\s\p{L}\p{N}]++[\r\n]*|\s*[\r\n]|\s+(?!\S)|\s+"""
+)
+
+# setup() prepares a run and returns the argument of run(), units is how
+# many items (messages, bytes) one run processes for the throughput
+Case = collections.namedtuple("Case", "group name size setup run units unit")
+
+
+def offline_encoding():
+    """a tiktoken Encoding that needs no download. Its tokens are bytes, so
+    the counts differ from the real encodings, but it splits text the same
+    way and costs about as much per byte"""
+    import tiktoken
+
+    return tiktoken.Encoding(
+        name="bench_bytes",
+        pat_str=CL100K_PATTERN,
+        mergeable_ranks={bytes([i]): i for i in range(256)},
+        special_tokens={},
+    )
+
+
+def chunk(role, content):
+    return SimpleNamespace(
+        choices=[SimpleNamespace(delta=SimpleNamespace(role=role, content=content))]
+    )
+
+
+def stream_chunks(text):
+    """the chunks of an openai stream of text, built before the run"""
+    return [chunk("assistant", "")] + [
+        chunk(None, delta) for delta in deltas(text, random.Random(1))
+    ]
+
+
+def token_cases(sizes):
+    cost_config = chat.CostConfig("gpt-4o", 0, 0)
+    for size in sizes:
+        messages = synthetic_messages(size)
+        count = lambda messages: chat.num_tokens_in_messages(messages, cost_config)
+
+        def cold(messages=messages):
+            chat._token_counts.clear()
+            return messages
+
+        def warm(messages=messages):
+            count(messages)
+            return messages
+
+        yield Case("tokens", "cold", size, cold, count, size, "msg")
+        yield Case("tokens", "memoized", size, warm, count, size, "msg")
+
+
+def storage_cases(sizes):
+    for size in sizes:
+        messages = synthetic_messages(size)
+        extra = chat.Message("user", "one more question")
+        session = f"bench{size}"
+
+        def fresh(session=session):
+            storage._persisted.pop(session, None)
+            path = storage.get_session_path(session, True)
+            if path:
+                os.unlink(path)
+            return session
+
+        def persisted(messages=messages, session=session):
+            storage._persisted.pop(session, None)
+            storage.to_cache(messages, session)
+            return session
+
+        yield Case(
+            "storage",
+            "write",
+            size,
+            fresh,
+            lambda session, messages=messages: storage.to_cache(messages, session),
+            size,
+            "msg",
+        )
+        yield Case(
+            "storage",
+            "append",
+            size,
+            persisted,
+            lambda session, messages=messages: storage.to_cache(
+                messages + [extra], session
+            ),
+            1,
+            "msg",
+        )
+        yield Case(
+            "storage",
+            "load",
+            size,
+            persisted,
+            storage.messages_from_cache,
+            size,
+            "msg",
+        )
+        yield Case(
+            "storage",
+            "load last",
+            size,
+            persisted,
+            storage.last_message_from_cache,
+            1,
+            "msg",
+        )
+
+
+def printer_cases(chars):
+    for name, text in printer_inputs(chars).items():
+
+        def fresh(text=text):
+            printer._latex_texts.clear()
+            return text
+
+        yield Case(
+            "printer",
+            name,
+            chars,
+            fresh,
+            printer.detect_and_format_message,
+            len(text.encode("utf-8")),
+            "B",
+        )
+
+
+def stream_cases(chars):
+    text = synthetic_response(chars)
+    size = len(text.encode("utf-8"))
+    chunks = stream_chunks(text)
+    document = json.dumps(text.split("\n\n"))
+    json_chunks = stream_chunks(document)
+
+    def consume(chunks):
+        stream = chat.map_from_stream(iter(chunks))
+        for _ in stream:
+            pass
+        return stream.message
+
+    def render(chunks):
+        printer.console = terminal()
+        args = utils.DotDict(raw=False, no_format=True, theme=None)
+        # every delta is drawn, as on a slow stream
+        with printer.StreamPrinter(args, refresh_per_second=1e9) as stream_printer:
+            for delta in chat.map_from_stream(iter(chunks)):
+                stream_printer.update(delta)
+
+    def extract(chunks):
+        extractor = printer.JsonExtractor()
+        for delta in chat.map_from_stream(iter(chunks)):
+            extractor.feed(delta)
+        return extractor.close()
+
+    yield Case("stream", "map_from_stream", chars, lambda: chunks, consume, size, "B")
+    yield Case("stream", "render", chars, lambda: chunks, render, size, "B")
+    yield Case(
+        "stream",
+        "extract json",
+        chars,
+        lambda: json_chunks,
+        extract,
+        len(document.encode("utf-8")),
+        "B",
+    )
+
+
+def measure(case, repeat):
+    """the peak memory of a first run, that also warms up caches and
+    imports, and the best time of repeat runs after it"""
+    argument = case.setup()
+    tracemalloc.start()
+    case.run(argument)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    timings = []
+    for _ in range(repeat):
+        argument = case.setup()
+        start = time.perf_counter()
+        case.run(argument)
+        timings.append(time.perf_counter() - start)
+    return min(timings), peak
+
+
+def throughput(case, seconds):
+    per_second = case.units / seconds if seconds else float("inf")
+    if case.unit == "B":
+        return f"{per_second / 1024 / 1024:.1f} MB/s"
+    return f"{per_second:,.0f} {case.unit}/s"
+
+
+def case_key(case):
+    return f"{case.group}/{case.name}/{case.size}"
+
+
+def bench(groups, sizes, chars, repeat, baseline, tolerance):
+    cache_dir = tempfile.mkdtemp()
+    storage.get_cache_path = lambda create=True: cache_dir
+    encoding = offline_encoding()
+    chat.get_encoding = lambda model: encoding
+
+    cases = {
+        "tokens": lambda: token_cases(sizes),
+        "storage": lambda: storage_cases(sizes),
+        "printer": lambda: printer_cases(chars),
+        "stream": lambda: stream_cases(chars),
+    }
+    results = {}
+    regressions = []
+    print(
+        f"{'case':<32} {'size':>7} {'time':>11} {'throughput':>16} {'peak mem':>10}"
+        f" {'vs baseline':>12}"
+    )
+    for group in groups:
+        for case in cases[group]():
+            seconds, peak = measure(case, repeat)
+            key = case_key(case)
+            results[key] = {"seconds": seconds, "peak": peak}
+            compared = ""
+            if key in baseline:
+                change = seconds / baseline[key]["seconds"] - 1
+                compared = f"{change:+.0%}"
+                if change > tolerance:
+                    compared += " !"
+                    regressions.append(key)
+            print(
+                f"{case.group + ' ' + case.name:<32} {case.size:>7}"
+                f" {seconds * 1000:>9.2f}ms {throughput(case, seconds):>16}"
+                f" {peak / 1024:>8.0f}KB {compared:>12}"
+            )
+    return results, regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--only",
+        nargs="+",
+        choices=["tokens", "storage", "printer", "stream"],
+        default=["tokens", "storage", "printer", "stream"],
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[10, 100, 1000, 10000],
+        help="the numbers of messages of the synthetic sessions",
+    )
+    parser.add_argument(
+        "--chars",
+        type=int,
+        default=20000,
+        help="the size of the printer inputs and streamed responses",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument(
+        "--save", action="store_true", help="store the results as the baseline"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="fail when a case is this much slower than the baseline",
+    )
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    results, regressions = bench(
+        args.only, args.sizes, args.chars, args.repeat, baseline, args.tolerance
+    )
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"saved baseline to {args.baseline}")
+    if regressions:
+        print(f"slower than the baseline: {', '.join(regressions)}")
+        sys.exit(1)
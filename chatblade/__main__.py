@@ -1,7 +1,14 @@
-from . import cli
+import sys
+
+from . import daemon
 
 
 def main():
+    code = daemon.run_client(sys.argv[1:])
+    if code is not None:
+        exit(code)
+    from . import cli
+
     cli.cli()
 
 
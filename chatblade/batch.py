@@ -0,0 +1,165 @@
+"""
+Runs a file of queries, one JSON object per line, concurrently and writes
+the results as JSON lines
+
+Each line is either a JSON string (the query) or an object with a "query"
+and optionally a "session", "prompt_file", "model" and an "id" that is
+copied to the result
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import sys
+
+from . import chat, errors, parser, storage
+
+
+def read_lines(path):
+    if path == "-":
+        return sys.stdin
+    try:
+        return open(path, "r")
+    except OSError as e:
+        raise errors.ChatbladeError(f"can't read batch file {path}: {e.strerror}")
+
+
+def parse_line(line):
+    entry = json.loads(line)
+    if isinstance(entry, str):
+        entry = {"query": entry}
+    if not isinstance(entry, dict) or not entry.get("query"):
+        raise ValueError("expected a query string or an object with a query")
+    session = entry.get("session")
+    if session is not None:
+        if not isinstance(session, str):
+            raise ValueError("expected the session to be a string")
+        try:
+            parser.valid_session(session)
+        except argparse.ArgumentTypeError as e:
+            raise ValueError(str(e))
+    return entry
+
+
+def resolve_model(entry, params):
+    if entry.get("model"):
+        return parser.model_mappings.get(entry["model"], entry["model"])
+    return params.model
+
+
+def init_messages(entry, session_messages):
+    if session_messages:
+        if entry.get("prompt_file"):
+            raise errors.ChatbladeError(
+                "refusing to prepend prompt to existing session"
+            )
+        return session_messages + [chat.Message("user", entry["query"])]
+    init_msgs = (
+        [storage.load_prompt_file(entry["prompt_file"])]
+        if entry.get("prompt_file")
+        else []
+    )
+    return chat.init_conversation(entry["query"], *init_msgs)
+
+
+async def run_entry(index, line, params, session_locks):
+    result = {"index": index}
+    try:
+        entry = parse_line(line)
+        for field in ["id", "session", "query"]:
+            if field in entry:
+                result[field] = entry[field]
+        config = {**params, "model": resolve_model(entry, params)}
+        result["model"] = config["model"]
+
+        session = entry.get("session")
+        if session:
+            async with session_locks[session]:
+                messages = init_messages(entry, storage.messages_from_cache(session))
+                response = await chat.query_chat_gpt_async(messages, config)
+                storage.to_cache(messages + [response], session, config["model"])
+        else:
+            messages = init_messages(entry, [])
+            response = await chat.query_chat_gpt_async(messages, config)
+
+        if params.extract:
+            from . import printer
+
+            result["response"] = printer.extract_content(response.content)
+        else:
+            result["response"] = response.content
+        if response.usage:
+            result["usage"] = {
+                "prompt_tokens": response.usage.prompt_tokens,
+                "completion_tokens": response.usage.completion_tokens,
+            }
+    except (errors.ChatbladeError, ValueError) as e:
+        result["error"] = str(e)
+    except Exception as e:  # any failure is the result of its line
+        result["error"] = f"{type(e).__name__}: {e}"
+    return result
+
+
+def write_result(result, out):
+    out.write(json.dumps(result, ensure_ascii=False) + "\n")
+    out.flush()
+
+
+async def run_batch(lines, params, out):
+    """run the queries in lines with at most params.batch_concurrency in
+    flight, write results in input order or in order of completion"""
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(params.batch_concurrency)
+    session_locks = collections.defaultdict(asyncio.Lock)
+    in_order = params.batch_order == "input"
+    finished = {}
+    next_index = 0
+    tasks = set()
+    failures = 0
+
+    def on_done(task):
+        nonlocal next_index, failures
+        slots.release()
+        tasks.discard(task)
+        result = task.result()
+        if "error" in result:
+            failures += 1
+        if not in_order:
+            write_result(result, out)
+            return
+        finished[result["index"]] = result
+        while next_index in finished:
+            write_result(finished.pop(next_index), out)
+            next_index += 1
+
+    index = 0
+    while True:
+        await slots.acquire()
+        # reading stdin may block on whatever is producing it
+        line = await loop.run_in_executor(None, lines.readline)
+        if not line:
+            slots.release()
+            break
+        if not line.strip():
+            slots.release()
+            continue
+        task = asyncio.ensure_future(run_entry(index, line, params, session_locks))
+        task.add_done_callback(on_done)
+        tasks.add(task)
+        index += 1
+
+    if tasks:
+        await asyncio.wait(set(tasks))
+    return failures
+
+
+def run(params):
+    """run a batch file, returns the exit code"""
+    lines = read_lines(params.batch)
+    try:
+        failures = asyncio.run(run_batch(lines, params, sys.stdout))
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+    return 1 if failures else 0
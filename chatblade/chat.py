@@ -1,32 +1,45 @@
 import collections
+import functools
+import hashlib
 import os
-import yaml
+import threading
+import time
 
-import tiktoken
-import openai
-from openai._exceptions import OpenAIError
+from . import utils, errors, timing
 
-from . import utils, errors
+# openai and tiktoken are imported where they are used, they are slow to
+# import and most invocations (sessions, printing) don't need them
 
 
-class Message(collections.namedtuple("Message", ["role", "content"])):
-    @staticmethod
-    def represent_for_yaml(dumper, msg):
-        val = []
-        md = msg._asdict()
+# the tokens an answer took as reported by the API, id is the id of the
+# response, which the usage ledger is keyed by
+Usage = collections.namedtuple("Usage", "id model prompt_tokens completion_tokens")
 
-        for fie in msg._fields:
-            val.append([dumper.represent_data(e) for e in (fie, md[fie])])
-
-        return yaml.nodes.MappingNode("tag:yaml.org,2002:map", val)
 
+class Message(
+    collections.namedtuple("Message", ["role", "content", "usage"], defaults=[None])
+):
     @classmethod
     def import_yaml(cls, seq):
         """instantiate from YAML provided representation"""
         return cls(**seq)
 
+    @classmethod
+    def import_json(cls, obj):
+        """instantiate from JSON provided representation"""
+        usage = obj.get("usage")
+        return cls(obj["role"], obj["content"], Usage(**usage) if usage else None)
+
+    def export_json(self):
+        """the JSON representation, with the usage only if known"""
+        obj = self.api_dict()
+        if self.usage:
+            obj["usage"] = self.usage._asdict()
+        return obj
 
-yaml.add_representer(Message, Message.represent_for_yaml)
+    def api_dict(self):
+        """the message as sent to the API, without the usage"""
+        return {"role": self.role, "content": self.content}
 
 
 CostConfig = collections.namedtuple("CostConfig", "name prompt_cost completion_cost")
@@ -37,35 +50,177 @@ costs = [
     CostConfig("gpt-4-turbo", 10, 30),
     CostConfig("gpt-4", 30, 60),
     CostConfig("gpt-4-1106-preview", 10, 60),
+    CostConfig("gpt-4o", 2.5, 10),
     CostConfig("gpt-4o-mini", 0.15, 0.075),
     CostConfig("o1-preview", 15, 60),
     CostConfig("o1-mini", 3, 1.5),
 ]
 
+UsageCalculation = collections.namedtuple(
+    "UsageCalculation", "name requests prompt_tokens completion_tokens cost"
+)
 
-def get_tokens_and_costs(messages):
-    return [
-        CostCalculation(
-            cost_config.name, *num_tokens_in_messages(messages, cost_config)
-        )
+
+def get_cost_config(model):
+    """the CostConfig of model, which may be a dated version of one, e.g.
+    gpt-4o-2024-08-06, or None if its prices aren't known"""
+    matches = [
+        cost_config
         for cost_config in costs
+        if model == cost_config.name or model.startswith(cost_config.name + "-")
     ]
+    return max(matches, key=lambda c: len(c.name), default=None)
 
 
-def num_tokens_in_messages(messages, cost_config):
-    """Returns the number of tokens used by a list of messages."""
+def usage_cost(model, prompt_tokens, completion_tokens):
+    """the cost of the tokens used with model, None if its prices aren't known"""
+    cost_config = get_cost_config(model)
+    if not cost_config:
+        return None
+    return (
+        cost_config.prompt_cost * prompt_tokens
+        + cost_config.completion_cost * completion_tokens
+    ) / 1000000
+
+
+def get_usage_and_costs(messages):
+    """Returns a UsageCalculation per model answering in messages from the
+    usage the API reported, no tokens are counted. Returns None if an answer
+    has no usage (it predates recording it or was cached)"""
+    totals = {}
+    for message in messages:
+        if message.role != "assistant":
+            continue
+        if not message.usage:
+            return None
+        usage = message.usage
+        requests, prompt, completion = totals.get(usage.model, (0, 0, 0))
+        totals[usage.model] = (
+            requests + 1,
+            prompt + usage.prompt_tokens,
+            completion + usage.completion_tokens,
+        )
+    return [
+        UsageCalculation(model, *total, usage_cost(model, *total[1:]))
+        for model, total in totals.items()
+    ]
+
+
+def map_usage(result):
+    """the Usage of an API response or final stream chunk, if it has one"""
+    usage = getattr(result, "usage", None)
+    if not usage:
+        return None
+    return Usage(result.id, result.model, usage.prompt_tokens, usage.completion_tokens)
+
+
+def get_tokens_and_costs(messages):
+    """Returns a CostCalculation per cost config. Messages are only encoded
+    once per distinct encoding, not once per cost config"""
+    counts_by_encoding = {}
+    calculations = []
+    for cost_config in costs:
+        encoding = get_encoding(cost_config.name)
+        if encoding.name not in counts_by_encoding:
+            counts_by_encoding[encoding.name] = message_token_counts(
+                messages, encoding
+            )
+        calculations.append(
+            CostCalculation(
+                cost_config.name,
+                *tokens_and_cost(
+                    messages, counts_by_encoding[encoding.name], cost_config
+                ),
+            )
+        )
+    return calculations
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model):
+    """Returns the tiktoken encoding for a model, falling back to cl100k_base"""
+    import tiktoken
+
     try:
-        encoding = tiktoken.encoding_for_model(f"{cost_config.name}-0301")
+        return tiktoken.encoding_for_model(f"{model}-0301")
     except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
+        return tiktoken.get_encoding("cl100k_base")
+
+
+# memoized token counts keyed by (encoding name, sha1 of the text)
+_token_counts = {}
+# the encodings in _token_counts
+_token_count_encodings = set()
+
+
+def text_digest(text):
+    return hashlib.sha1(text.encode("utf-8", "surrogatepass")).hexdigest()
+
+
+def known_token_counts(messages):
+    """Returns the memoized token counts for the texts in messages as
+    {encoding name: {digest: count}}"""
+    digests = {
+        text_digest(text)
+        for message in messages
+        for text in (message.role, message.content)
+    }
+    counts = {}
+    for encoding_name in _token_count_encodings:
+        for digest in digests:
+            count = _token_counts.get((encoding_name, digest))
+            if count is not None:
+                counts.setdefault(encoding_name, {})[digest] = count
+    return counts
+
+
+def load_token_counts(counts):
+    """Seeds the token count memo with counts as returned by known_token_counts"""
+    for encoding_name, digests in counts.items():
+        _token_count_encodings.add(encoding_name)
+        for digest, count in digests.items():
+            _token_counts[(encoding_name, digest)] = count
+
+
+def forget_token_counts(messages):
+    """Drops the memoized token counts for the texts in messages"""
+    digests = {
+        text_digest(text)
+        for message in messages
+        for text in (message.role, message.content)
+    }
+    for encoding_name in _token_count_encodings:
+        for digest in digests:
+            _token_counts.pop((encoding_name, digest), None)
+
+
+def num_tokens_in_text(text, encoding):
+    key = (encoding.name, text_digest(text))
+    if key not in _token_counts:
+        _token_count_encodings.add(encoding.name)
+        _token_counts[key] = len(encoding.encode(text))
+    return _token_counts[key]
+
+
+def num_tokens_in_message(message, encoding):
+    """Returns the number of tokens used by a single message"""
+    return (
+        4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
+        + num_tokens_in_text(message.role, encoding)
+        + num_tokens_in_text(message.content, encoding)
+    )
+
+
+def message_token_counts(messages, encoding):
+    return [num_tokens_in_message(message, encoding) for message in messages]
+
+
+def tokens_and_cost(messages, token_counts, cost_config):
+    """Returns the number of tokens and the cost of a list of messages
+    given their per message token counts"""
     num_tokens = 0
     cost = 0
-    for i, message in enumerate(messages):
-        msg_tokens = (
-            4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
-        )
-        msg_tokens += len(encoding.encode(message.role))
-        msg_tokens += len(encoding.encode(message.content))
+    for i, (message, msg_tokens) in enumerate(zip(messages, token_counts)):
         if i == len(messages) - 1 and message.role == "assistant":
             cost += cost_config.completion_cost * msg_tokens
         else:
@@ -77,6 +232,14 @@ def num_tokens_in_messages(messages, cost_config):
     return num_tokens, cost / 1000000
 
 
+def num_tokens_in_messages(messages, cost_config):
+    """Returns the number of tokens used by a list of messages."""
+    encoding = get_encoding(cost_config.name)
+    return tokens_and_cost(
+        messages, message_token_counts(messages, encoding), cost_config
+    )
+
+
 def init_conversation(user_msg, system_msg=None):
     system = [Message("system", system_msg)] if system_msg else []
     return system + [Message("user", user_msg)]
@@ -90,49 +253,253 @@ DEFAULT_OPENAI_SETTINGS = {
 }
 
 
+class MessageStream:
+    """iterates over the content deltas of a streamed response, the
+    completed Message is available as .message once it is exhausted"""
+
+    def __init__(self, openai_gen):
+        self.openai_gen = openai_gen
+        self.role = None
+        self.chunks = []
+        self.on_complete = []
+        # when the request was sent, for the time to first token
+        self.started = None
+        # reported in the last chunk when requested with include_usage
+        self.usage = None
+
+    def __iter__(self):
+        deltas = 0
+        first = None
+        for role, content in self.updates():
+            if role:
+                self.role = role
+            if content:
+                if not deltas:
+                    first = time.perf_counter()
+                    if self.started:
+                        timing.record("ttft", self.started, first)
+                deltas += 1
+                self.chunks.append(content)
+                yield content
+        if self.started and deltas:
+            # a delta usually holds a single token, when the usage is missing
+            tokens = self.usage.completion_tokens if self.usage else deltas
+            elapsed = time.perf_counter() - first
+            rate = (tokens - 1) / elapsed if tokens > 1 and elapsed else None
+            timing.record("stream", first, tokens=tokens, tokens_per_sec=rate)
+        for callback in self.on_complete:
+            callback(self.message)
+
+    def updates(self):
+        """(role, content) of every update in the stream"""
+        for update in self.openai_gen:
+            if not update.choices:
+                self.usage = map_usage(update) or self.usage
+                continue
+            delta = update.choices[0].delta
+            yield delta.role, delta.content
+
+    @property
+    def content(self):
+        """the content received so far"""
+        if len(self.chunks) > 1:
+            self.chunks[:] = ["".join(self.chunks)]
+        return self.chunks[0] if self.chunks else ""
+
+    @property
+    def message(self):
+        return Message(self.role, self.content, self.usage)
+
+
+class ReplayedMessageStream(MessageStream):
+    """a MessageStream replaying an already complete message in chunks"""
+
+    def __init__(self, message, chunk_size=16):
+        super().__init__(None)
+        self.replayed = message
+        self.chunk_size = chunk_size
+
+    def updates(self):
+        yield self.replayed.role, None
+        content = self.replayed.content
+        for i in range(0, len(content), self.chunk_size):
+            yield None, content[i : i + self.chunk_size]
+
+
 def map_from_stream(openai_gen):
-    """maps a openai streaming generator a stream of Message with the
-    final one being the completed Message"""
-    role, message = None, ""
-    for update in openai_gen:
-        delta = [choice.delta for choice in update.choices][0]
-        if delta.role:
-            role = delta.role
-        elif delta.content:
-            message += delta.content
-        yield Message(role, message)
+    """maps a openai streaming generator to a MessageStream of content deltas"""
+    return MessageStream(openai_gen)
 
 
 def map_single(result):
     """maps a result to a Message"""
     response_message = [choice.message for choice in result.choices][0]
-    return Message(response_message.role, response_message.content)
+    return Message(
+        response_message.role, response_message.content, map_usage(result)
+    )
+
+
+# clients are kept for the lifetime of the process, keyed by everything that
+# configures them, so queries (e.g. REPL turns) reuse their open connections
+_clients = {}
+# fan-out builds the clients of its models from several threads
+_clients_lock = threading.Lock()
+
+# how long an idle connection is kept open, long enough to outlast the user
+# typing the next query in the REPL
+KEEPALIVE_EXPIRY = 120
+
+# when the connection pools of the clients were last used, by client_key
+_last_used = {}
+
+
+def client_key(config, asynchronous=False):
+    return (
+        config["openai_base_url"],
+        config["openai_api_key"],
+        os.environ.get("OPENAI_API_AZURE_ENGINE"),
+        asynchronous,
+    )
+
+
+def build_client(config, asynchronous=False):
+    key = client_key(config, asynchronous)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = new_client(config, key)
+        return _clients[key]
 
 
-def build_client(config):
-    if "OPENAI_API_AZURE_ENGINE" in os.environ:
-        return openai.AzureOpenAI(
+def new_client(config, key):
+    import httpx
+    import openai
+
+    _, _, azure_deployment, asynchronous = key
+    limits = httpx.Limits(
+        max_connections=100,
+        max_keepalive_connections=20,
+        keepalive_expiry=KEEPALIVE_EXPIRY,
+    )
+    if asynchronous:
+        http_client = openai.DefaultAsyncHttpxClient(limits=limits)
+        azure_class, openai_class = openai.AsyncAzureOpenAI, openai.AsyncOpenAI
+    else:
+        http_client = openai.DefaultHttpxClient(limits=limits)
+        azure_class, openai_class = openai.AzureOpenAI, openai.OpenAI
+    if azure_deployment:
+        client = azure_class(
             api_key=config["openai_api_key"],
-            azure_deployment=os.environ.get("OPENAI_API_AZURE_ENGINE"),
+            azure_deployment=azure_deployment,
+            http_client=http_client,
         )
     else:
-        return openai.OpenAI(
-            api_key=config["openai_api_key"], base_url=config["openai_base_url"]
+        client = openai_class(
+            api_key=config["openai_api_key"],
+            base_url=config["openai_base_url"],
+            http_client=http_client,
         )
+    return client
+
+
+def warm_up(config):
+    """open a connection to the API in the background, so the next query
+    doesn't wait for the connection and TLS handshake, unless one is kept
+    alive from a recent request. Failures are ignored, the query will just
+    open its own connection"""
+    key = client_key(config)
+    if time.monotonic() - _last_used.get(key, -KEEPALIVE_EXPIRY) < KEEPALIVE_EXPIRY:
+        return
+    _last_used[key] = time.monotonic()
+
+    def connect():
+        try:
+            client = build_client(config)
+            client.with_options(max_retries=0, timeout=10).models.list()
+        except Exception:
+            pass
+
+    threading.Thread(target=connect, daemon=True).start()
+
+
+# the endpoints that rejected stream_options, as (base url, azure deployment)
+_without_stream_options = set()
 
 
 def query_chat_gpt(messages, config):
     """Queries the chat GPT API with the given messages and config."""
-    client = build_client(config)
+    # importing openai is a good part of getting a client
+    with timing.span("client"):
+        import openai
+
+        from . import ratelimit
+
+        # retries are left to ratelimit, which shares its backoff across processes
+        client = build_client(config).with_options(max_retries=0)
+    _last_used[client_key(config)] = time.monotonic()
+    params = config
     config = utils.merge_dicts(DEFAULT_OPENAI_SETTINGS, config)
-    dict_messages = [msg._asdict() for msg in messages]
+    azure_deployment = os.environ.get("OPENAI_API_AZURE_ENGINE")
+    endpoint = (params.get("openai_base_url"), azure_deployment)
+    if config["stream"] and endpoint not in _without_stream_options:
+        # the usage is only sent in a last chunk when asked for
+        config["stream_options"] = {"include_usage": True}
+    dict_messages = [msg.api_dict() for msg in messages]
+
+    def create():
+        return ratelimit.call(
+            lambda: client.chat.completions.create(messages=dict_messages, **config),
+            messages,
+            params,
+        )
+
     try:
-        result = client.chat.completions.create(messages=dict_messages, **config)
+        started = time.perf_counter()
+        # until the response arrived, or its headers when streamed
+        with timing.span("request"):
+            try:
+                result = create()
+            except openai.BadRequestError as e:
+                # older azure api versions and some compatible servers don't
+                # know it, the answer is stored without its usage then
+                if "stream_options" not in config or "stream_options" not in str(e):
+                    raise
+                _without_stream_options.add(endpoint)
+                del config["stream_options"]
+                result = create()
         if isinstance(result, openai._streaming.Stream):
-            return map_from_stream(result)
+            stream = map_from_stream(result)
+            stream.started = started
+            return stream
         elif isinstance(result, openai.types.chat.ChatCompletion):
             return map_single(result)
         else:
             raise ValueError(f"unexpected result openai: {result}")
-    except OpenAIError as e:
+    except openai.OpenAIError as e:
+        raise errors.ChatbladeError(f"openai error: {e}")
+
+
+async def query_chat_gpt_async(messages, config):
+    """Queries the chat GPT API with the given messages and config, without
+    streaming, on an asyncio client"""
+    with timing.span("client"):
+        import openai
+
+        from . import ratelimit
+
+        client = build_client(config, asynchronous=True).with_options(max_retries=0)
+    params = config
+    config = utils.merge_dicts(DEFAULT_OPENAI_SETTINGS, config)
+    config["stream"] = False
+    dict_messages = [msg.api_dict() for msg in messages]
+    try:
+        with timing.span("request"):
+            result = await ratelimit.call_async(
+                lambda: client.chat.completions.create(
+                    messages=dict_messages, **config
+                ),
+                messages,
+                params,
+            )
+        return map_single(result)
+    except openai.OpenAIError as e:
         raise errors.ChatbladeError(f"openai error: {e}")
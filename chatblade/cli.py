@@ -1,34 +1,49 @@
 import sys
-import types
 import os
+import shutil
 
-import rich
-from rich.prompt import Prompt
-from rich.live import Live
-from rich.text import Text
+from . import chat, utils, storage, errors, parser, session, timing
 
-from . import printer, chat, utils, storage, errors, parser, session
+# printer pulls in rich and is imported by the code paths that print, so
+# session operations and --version don't pay for it
 
 
 def fetch_and_cache(messages, params):
-    result = chat.query_chat_gpt(messages, params)
-    if isinstance(result, types.GeneratorType):
-        text = Text("")
-        message = None
-        with Live(text, refresh_per_second=4, vertical_overflow="visible") as live:
-            for message in result:
-                live.update(message.content)
-            live.update("")
-        response_msg = message
+    from . import printer
+
+    from . import context
+
+    sent = context.fit_messages(messages, params)
+    if params.cache:
+        from . import response_cache
+
+        result = response_cache.query_chat_gpt(sent, params)
+    else:
+        result = chat.query_chat_gpt(sent, params)
+    if isinstance(result, chat.MessageStream):
+        if params.extract:
+            printer.print_extracted_stream(result)
+        else:
+            with printer.StreamPrinter(params) as stream_printer:
+                update = timing.timed("render", stream_printer.update)
+                for delta in result:
+                    update(delta)
+        response_msg = result.message
     else:
         response_msg = result
     messages.append(response_msg)
-    storage.to_cache(messages, params.session or utils.scratch_session)
+    storage.to_cache(messages, params.session or utils.scratch_session, params.model)
     return messages
 
 
 def start_repl(messages, params):
+    import rich
+    from rich.prompt import Prompt
+    from . import printer
+
     while True:
+        if not params.no_warm_up:
+            chat.warm_up(params)
         try:
             query = Prompt.ask("[yellow]query (type 'quit' to exit)[/yellow]")
         except (EOFError, KeyboardInterrupt):
@@ -48,15 +63,96 @@ def start_repl(messages, params):
             messages.append(chat.Message("user", query))
 
         messages = fetch_and_cache(messages, params)
-        printer.print_messages(messages[-1:], params)
+        if not params.stream:
+            printer.print_messages(messages[-1:], params)
+
+
+def select_messages(messages, params):
+    """the messages selected with --tail or --range"""
+    if params.tail:
+        return messages[-params.tail :]
+    if params.range:
+        return messages[slice(*params.range)]
+    return messages
+
+
+def print_messages(messages, params):
+    print_selected(select_messages(messages, params), params)
+
+
+def print_selected(messages, params):
+    """print messages, an iterable that may read them as they are printed,
+    through the pager with --pager. The latex conversions of a session are
+    kept in its latex sidecar so printing it again doesn't convert them again"""
+    from . import printer
+
+    with printer.paged(params.pager), timing.span("render"):
+        if not params.session or params.raw or params.extract:
+            printer.print_messages(messages, params)
+            return
+        known = storage.sidecar_from_cache(params.session, "latex") or {}
+        printer.load_latex_texts(known)
+        printed = []
+
+        def printing():
+            for message in messages:
+                printed.append(message)
+                yield message
+
+        printer.print_messages(printing(), params)
+    texts = {**known, **printer.known_latex_texts(printed)}
+    if texts != known and storage.get_session_path(params.session, True):
+        storage.sidecar_to_cache(texts, params.session, "latex")
+
+
+def show_session(params):
+    """print the messages of the session selected with --tail or --range,
+    reading only those and printing each as soon as it is read. Returns
+    False if the session doesn't exist or still needs an answer"""
+    last = storage.last_message_from_cache(params.session)
+    if last is None or last.role == "user":
+        return False
+    if params.tail:
+        messages = storage.tail_messages_from_cache(params.session, params.tail)
+    else:
+        messages = storage.iter_messages_from_cache(
+            params.session, *(params.range or (0, None))
+        )
+    print_selected(messages, params)
+    return True
+
+
+def load_session(query, params):
+    """load the messages of the session, only the last one when that is
+    all that will be used"""
+    if params.extract and not (query or params.tokens or params.interactive):
+        last = storage.last_message_from_cache(params.session)
+        if last is None:
+            return []
+        if last.role != "user":
+            return [last]
+    return storage.messages_from_cache(params.session)
 
 
 def handle_input(query, params):
+    with timing.span("import printer"):
+        from . import printer
+
     utils.debug(title="cli input", query=query, params=params)
+    if params.interactive and len(params.models) > 1:
+        printer.warn("interactive sessions use a single model")
+        exit(1)
+
+    if params.session and not (
+        query or params.tokens or params.interactive or params.extract
+    ):
+        if show_session(params):
+            return
 
     messages = None
     if params.session:
-        messages = storage.messages_from_cache(params.session)
+        with timing.span("load session"):
+            messages = load_session(query, params)
     if messages:  # a session specified and it alredy exists
         if params.prompt_file:
             printer.warn("refusing to prepend prompt to existing session")
@@ -74,12 +170,32 @@ def handle_input(query, params):
 
     if messages:
         if params.tokens:
-            token_prices = chat.get_tokens_and_costs(messages)
-            printer.print_tokens(messages, token_prices, params)
+            # a past session costs what the API reported, nothing is counted
+            usage = None if query else chat.get_usage_and_costs(messages)
+            if usage and messages[-1].role == "assistant":
+                printer.print_usage(messages, usage, params)
+            else:
+                token_prices = chat.get_tokens_and_costs(messages)
+                if params.session:
+                    storage.token_counts_to_cache(messages, params.session)
+                printer.print_tokens(messages, token_prices, params)
+        elif messages[-1].role == "user" and len(params.models) > 1:
+            from . import fanout
+
+            if not params.extract:
+                print_messages(messages, params)
+            answers = fanout.fetch_and_cache(messages, params)
+            printer.print_answers(answers, params)
+            if all(isinstance(a, errors.ChatbladeError) for a in answers.values()):
+                exit(1)
+        elif messages[-1].role == "user" and params.stream:
+            if not params.extract:
+                print_messages(messages, params)
+            messages = fetch_and_cache(messages, params)
         else:
             if messages[-1].role == "user":
                 messages = fetch_and_cache(messages, params)
-            printer.print_messages(messages, params)
+            print_messages(messages, params)
     elif params.interactive:
         pass
     else:
@@ -96,11 +212,113 @@ def handle_input(query, params):
         start_repl(messages, params)
 
 
-def do_session_op(sess, op, rename_to):
-    if op == "list":
-        print(*session.list_sessions(), sep="\n")
+def list_sessions(params):
+    """list the sessions, with their stats in a table on a terminal"""
+    from . import index
+
+    sessions = index.list_sessions(
+        params.session_sort,
+        params.session_prefix,
+        params.session_max_age,
+        params.session_min_tokens,
+    )
+    if not sys.stdout.isatty():
+        print(*[info.name for info in sessions], sep="\n")
         return 0
 
+    import time
+    from . import printer
+    from rich.table import Table
+
+    table = Table(box=None)
+    table.add_column("Session")
+    table.add_column("Messages", justify="right")
+    table.add_column("Tokens", justify="right")
+    table.add_column("Model")
+    table.add_column("Created")
+    table.add_column("Updated")
+    for info in sessions:
+        table.add_row(
+            info.name,
+            str(info.messages),
+            "?" if info.tokens is None else str(info.tokens),
+            info.model or "",
+            time.strftime("%Y-%m-%d %H:%M", time.localtime(info.created)),
+            time.strftime("%Y-%m-%d %H:%M", time.localtime(info.updated)),
+        )
+    printer.console.print(table)
+    return 0
+
+
+def search_sessions(params):
+    """print the messages of the sessions matching the search terms"""
+    from . import index, printer
+
+    hits = index.search(
+        params.session_search, params.session, params.session_search_limit
+    )
+    if not hits:
+        printer.warn("no messages match")
+        return 1
+    for hit in hits:
+        printer.print_message(
+            chat.Message(hit.role, hit.content),
+            params,
+            title=f"{hit.session} #{hit.position + 1} {hit.role}",
+        )
+    return 0
+
+
+def session_usage(params):
+    """report the usage ledger by session and model, in a table on a terminal"""
+    from . import index
+
+    totals = index.usage_totals(params.session, params.session_max_age)
+    costs = [
+        chat.usage_cost(total.model, total.prompt_tokens, total.completion_tokens)
+        for total in totals
+    ]
+    if not sys.stdout.isatty():
+        for total, cost in zip(totals, costs):
+            print(*total, "" if cost is None else f"{cost:.6f}", sep="\t")
+        return 0
+
+    from . import printer
+    from rich.table import Table
+
+    table = Table(box=None, show_footer=len(totals) > 1)
+    table.add_column("Session", footer="total")
+    table.add_column("Model")
+    table.add_column("Answers", justify="right")
+    table.add_column(
+        "Prompt tokens",
+        justify="right",
+        footer=str(sum(total.prompt_tokens for total in totals)),
+    )
+    table.add_column(
+        "Completion tokens",
+        justify="right",
+        footer=str(sum(total.completion_tokens for total in totals)),
+    )
+    table.add_column(
+        "Price",
+        justify="right",
+        footer="${:.6f}".format(sum(cost for cost in costs if cost)),
+    )
+    for total, cost in zip(totals, costs):
+        table.add_row(
+            total.session,
+            total.model,
+            str(total.requests),
+            str(total.prompt_tokens),
+            str(total.completion_tokens),
+            "?" if cost is None else "${:.6f}".format(cost),
+        )
+    printer.console.print(table)
+    return 0
+
+
+def do_session_op(sess, op, rename_to):
     err = None
     if not sess:
         err = "session name required"
@@ -108,11 +326,10 @@ def do_session_op(sess, op, rename_to):
         sess_path = storage.get_session_path(sess, True)
         if sess_path:
             if op == "path":
-                data = sess_path
+                print(sess_path)
             else:
                 with open(sess_path, "r") as f:
-                    data = f.read()
-            print(data)
+                    shutil.copyfileobj(f, sys.stdout)
         else:
             err = "session does not exist"
     elif op == "delete":
@@ -123,6 +340,8 @@ def do_session_op(sess, op, rename_to):
         raise ValueError(f"unknown session operation: {op}")
 
     if err:
+        from . import printer
+
         printer.warn(err)
         return 1
 
@@ -135,6 +354,8 @@ def migrate_old_cache_file_if_exists():
         try:
             storage.migrate_to_session(utils.scratch_session)
         except Exception as e:
+            from . import printer
+
             printer.warn(f"failed to migrate old cache file: {e}")
             return 1
 
@@ -143,6 +364,26 @@ def cli():
     migrate_old_cache_file_if_exists()
 
     query, params = parser.parse(sys.argv[1:])
+    if params.profile or params.profile_file:
+        timing.enable(params.profile_file)
+        # importing chatblade and parsing the arguments
+        timing.record("startup", timing.ORIGIN)
+    if params.daemon or params.daemon_stop:
+        from . import daemon
+
+        try:
+            exit(daemon.serve() if params.daemon else daemon.stop())
+        except errors.ChatbladeError as e:
+            from . import printer
+
+            printer.warn(e)
+            exit(1)
+    if params.session_search:
+        exit(search_sessions(params))
+    if params.session_op == "list":
+        exit(list_sessions(params))
+    if params.session_op == "usage":
+        exit(session_usage(params))
     if params.session_op:
         ret = do_session_op(params.session, params.session_op, params.rename_to)
         exit(ret)
@@ -152,8 +393,25 @@ def cli():
         from importlib.metadata import version as get_version
         print(f"chatblade {get_version('chatblade')}")
         exit(0)
+    if params.batch:
+        from . import batch
+
+        try:
+            exit(batch.run(params))
+        except errors.ChatbladeError as e:
+            from . import printer
+
+            printer.warn(e)
+            exit(1)
     try:
-        handle_input(query, params)
+        if params.map_reduce:
+            from . import mapreduce
+
+            mapreduce.run(query, params)
+        else:
+            handle_input(query, params)
     except errors.ChatbladeError as e:
+        from . import printer
+
         printer.warn(e)
         exit(1)
@@ -0,0 +1,153 @@
+"""
+Keeps the messages sent to the model within its context window
+
+When a conversation outgrows the token budget (by default the context window
+of the model minus room for the answer) the oldest turns are left out, the
+system prompt is always kept. With summarizing enabled, the turns left out
+are folded into a rolling summary instead, which is stored with the session
+so it only needs to be extended when more turns are left out
+"""
+
+from . import chat, storage, utils
+
+# https://platform.openai.com/docs/models
+CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 16385,
+    "gpt-4": 8192,
+    "gpt-4-turbo": 128000,
+    "gpt-4-1106-preview": 128000,
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+    "o1-preview": 128000,
+    "o1-mini": 128000,
+}
+
+# room kept for the answer, at most a quarter of the window
+ANSWER_RESERVE = 4096
+
+# share of the budget a summary may take, folding leaves this much room
+SUMMARY_SHARE = 0.25
+
+SUMMARY_PROMPT = """Summarize the conversation below, including the summary of
+the conversation before it if there is one, in at most {words} words. Keep the
+facts, decisions, code and open questions needed to continue the conversation."""
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+
+def get_context_window(model):
+    """the context window of a model, also for dated versions of it"""
+    matches = [name for name in CONTEXT_WINDOWS if model.startswith(name)]
+    if not matches:
+        return None
+    return CONTEXT_WINDOWS[max(matches, key=len)]
+
+
+def get_budget(params):
+    if params.context_tokens:
+        return params.context_tokens
+    window = get_context_window(params.model)
+    if not window:
+        return None
+    return window - min(ANSWER_RESERVE, window // 4)
+
+
+def upper_bound_tokens(messages):
+    """a token never encodes less than a byte, so this is never less than
+    the actual number of tokens and is a lot cheaper to compute"""
+    return sum(
+        4 + len(msg.role) + len(msg.content.encode("utf-8", "surrogatepass"))
+        for msg in messages
+    ) + 2
+
+
+def fit_messages(messages, params):
+    """the messages to send so they fit the token budget"""
+    budget = get_budget(params)
+    if not budget or upper_bound_tokens(messages) <= budget:
+        return messages
+    encoding = chat.get_encoding(params.model)
+    counts = chat.message_token_counts(messages, encoding)
+    if sum(counts) + 2 <= budget:
+        return messages
+
+    head = 0
+    while head < len(messages) - 1 and messages[head].role == "system":
+        head += 1
+    if params.context_summarize:
+        fitted = fold(messages, counts, head, budget, params)
+    else:
+        keep_from = oldest_fitting(counts, head, budget - sum(counts[:head]) - 2)
+        fitted = messages[:head] + messages[keep_from:]
+    utils.debug(
+        title="context", budget=budget, messages=len(messages), sent=len(fitted)
+    )
+    return fitted
+
+
+def oldest_fitting(counts, start, budget):
+    """the index of the oldest message from which on all messages fit budget,
+    at least the last message is kept and nothing before start"""
+    keep_from = len(counts) - 1
+    total = counts[keep_from]
+    while keep_from > start and total + counts[keep_from - 1] <= budget:
+        keep_from -= 1
+        total += counts[keep_from]
+    return keep_from
+
+
+def fold(messages, counts, head, budget, params):
+    """leave out the oldest turns, folded into the (stored) rolling summary"""
+    session = params.session or utils.scratch_session
+    summary = valid_summary(storage.sidecar_from_cache(session, "summary"), messages)
+    upto = summary["upto"] if summary else head
+    head_msgs = messages[:head]
+    head_tokens = sum(counts[:head]) + 2
+    if summary:
+        summary_msg = summary_message(summary)
+        encoding = chat.get_encoding(params.model)
+        summary_tokens = chat.num_tokens_in_message(summary_msg, encoding)
+        if head_tokens + summary_tokens + sum(counts[upto:]) <= budget:
+            return head_msgs + [summary_msg] + messages[upto:]
+
+    # fold enough to leave room for the summary, so the next turns fit as is
+    summary_budget = int(budget * SUMMARY_SHARE)
+    keep_from = oldest_fitting(counts, upto, budget - head_tokens - summary_budget)
+    if keep_from <= upto:  # nothing left to fold
+        return head_msgs + ([summary_msg] if summary else []) + messages[upto:]
+    folded = messages[upto:keep_from]
+    summary = {
+        "upto": keep_from,
+        "digest": chat.text_digest(messages[keep_from - 1].content),
+        "content": summarize(summary, folded, summary_budget, params),
+    }
+    storage.sidecar_to_cache(summary, session, "summary")
+    return head_msgs + [summary_message(summary)] + messages[keep_from:]
+
+
+def valid_summary(summary, messages):
+    """the stored summary, if it summarizes the start of these messages"""
+    if not summary or summary["upto"] >= len(messages):
+        return None
+    last_folded = messages[summary["upto"] - 1]
+    if chat.text_digest(last_folded.content) != summary["digest"]:
+        return None
+    return summary
+
+
+def summary_message(summary):
+    return chat.Message("system", SUMMARY_PREFIX + summary["content"])
+
+
+def summarize(summary, messages, max_tokens, params):
+    transcript = [SUMMARY_PREFIX + summary["content"]] if summary else []
+    transcript += [f"{msg.role}: {msg.content}" for msg in messages]
+    words = max(max_tokens * 3 // 4, 50)  # about 3/4 of a word per token
+    response = chat.query_chat_gpt(
+        [
+            chat.Message("system", SUMMARY_PROMPT.format(words=words)),
+            chat.Message("user", "\n\n".join(transcript)),
+        ],
+        utils.DotDict({**params, "stream": False}),
+    )
+    return response.content
@@ -0,0 +1,534 @@
+"""
+A background process (chatblade --daemon) that later chatblade invocations
+run in, so they don't import openai, rich, tiktoken and pylatexenc, load the
+tokenizers or read their session again
+
+The daemon imports and loads all of that once and listens on a unix socket
+in the cache path. The chatblade command connects to it when it is running
+and sends its arguments, working directory and environment, and its stdin,
+stdout and stderr as file descriptors. The daemon forks a worker per
+invocation, which inherits everything loaded and runs the invocation on
+those descriptors, so it behaves exactly like a chatblade run on its own
+(terminal detection, piped input, -i). Ctrl-C is passed on to the worker,
+and its exit code is the exit code of the command.
+
+Sessions the workers write are kept in memory by the daemon for the next
+invocations. The workers leave syncing the session file to disk, updating
+the session index and the token counts to the daemon, which does that after
+the answer was printed (write-behind), when it is idle or within
+FLUSH_MAX_DELAY seconds
+"""
+
+import array
+import json
+import os
+import socket
+import sys
+import time
+
+# when this process started, as near as the client can tell, for --profile
+STARTED = time.perf_counter()
+
+# options that run in the chatblade process itself
+LOCAL_OPTIONS = {"--daemon", "--daemon-stop", "--pager"}
+
+READ_SIZE = 64 * 1024
+
+# write-behind waits for the daemon to be idle that long, but never longer
+# than FLUSH_MAX_DELAY behind the write
+FLUSH_IDLE = 0.05
+FLUSH_MAX_DELAY = 1
+
+
+def get_socket_path():
+    from . import storage
+
+    return os.path.join(storage.get_cache_path(), "daemon.sock")
+
+
+def supported():
+    return hasattr(socket, "AF_UNIX") and hasattr(os, "fork")
+
+
+def send_request(sock, request, fds=()):
+    """send request as a json line, with fds attached"""
+    data = json.dumps(request).encode("utf-8") + b"\n"
+    ancillary = []
+    if fds:
+        ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))]
+    sent = sock.sendmsg([data], ancillary)
+    if sent < len(data):
+        sock.sendall(data[sent:])
+
+
+def receive_request(sock):
+    """the request sent with send_request and the fds attached to it, None
+    when the connection was closed without one"""
+    fds = array.array("i")
+    data, ancillary, _, _ = sock.recvmsg(
+        READ_SIZE, socket.CMSG_LEN(3 * fds.itemsize)
+    )
+    for level, kind, cdata in ancillary:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(cdata[: len(cdata) - len(cdata) % fds.itemsize])
+    if not data:  # checked if a daemon is running
+        return None, list(fds)
+    while not data.endswith(b"\n"):
+        chunk = sock.recv(READ_SIZE)
+        if not chunk:
+            raise ConnectionError("incomplete request")
+        data += chunk
+    return json.loads(data), list(fds)
+
+
+def connect():
+    """a socket connected to the daemon, None if it isn't running"""
+    path = get_socket_path()
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def run_client(argv):
+    """run chatblade with argv in the daemon and return its exit code, or
+    None when it should run in this process (no daemon is running)"""
+    if (
+        not supported()
+        or os.environ.get("CHATBLADE_NO_DAEMON")
+        or LOCAL_OPTIONS.intersection(argv)
+    ):
+        return None
+    sock = connect()
+    if not sock:
+        return None
+    with sock:
+        request = {
+            "argv": argv,
+            "cwd": os.getcwd(),
+            "env": dict(os.environ),
+            "started": STARTED,
+        }
+        try:
+            send_request(sock, request, [0, 1, 2])
+        except OSError:  # a closed stdin, stdout or stderr can't be sent
+            return None
+        reply = b""
+        while not reply.endswith(b"\n"):
+            try:
+                chunk = sock.recv(16)
+            except KeyboardInterrupt:
+                sock.sendall(b"i")  # for the worker
+                continue
+            if not chunk:
+                print("chatblade: the daemon stopped", file=sys.stderr)
+                return 1
+            reply += chunk
+    return int(reply)
+
+
+def stop():
+    """stop the running daemon once it has finished its invocations"""
+    from . import printer
+
+    sock = connect()
+    if not sock:
+        printer.warn("no daemon running")
+        return 1
+    with sock:
+        send_request(sock, {"stop": True})
+        sock.recv(1)  # closed when stopping
+    return 0
+
+
+def log(message):
+    print(f"chatblade daemon: {message}", file=sys.stderr, flush=True)
+
+
+def exit_code(code):
+    """the exit code of a SystemExit code"""
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    print(code, file=sys.stderr)
+    return 1
+
+
+def warm_up():
+    """import and load what invocations need, for the workers to inherit"""
+    import openai  # noqa: F401
+    import rich.prompt  # noqa: F401
+
+    from . import batch, cli, context, fanout, index, mapreduce  # noqa: F401
+    from . import parser, printer, ratelimit, response_cache, session  # noqa: F401
+    from . import chat
+
+    for model in sorted(set(parser.model_mappings.values())):
+        try:
+            chat.get_encoding(model)
+        except Exception as e:  # offline, it is loaded by the workers then
+            log(f"no tokenizer for {model}: {e!r}")
+    printer.get_latex_converter()
+    try:
+        # with its ssl context, connections are opened by the workers
+        chat.build_client(
+            {
+                "openai_base_url": None,
+                "openai_api_key": os.environ.get("OPENAI_API_KEY"),
+            }
+        )
+    except Exception as e:
+        log(f"no client: {e!r}")
+
+
+def reopen_stdio():
+    """sys.stdin, stdout and stderr for the descriptors the client sent"""
+    sys.stdin = open(0, "r", encoding="utf-8", closefd=False)
+    sys.stdout = open(
+        1, "w", buffering=1 if os.isatty(1) else -1, encoding="utf-8", closefd=False
+    )
+    sys.stderr = open(
+        2, "w", buffering=1, encoding="utf-8", errors="backslashreplace", closefd=False
+    )
+
+
+def run_worker(request, fds, write_behind_fd, cache_path):
+    """run the invocation of request in a forked worker, returns its exit code"""
+    from rich.console import Console
+
+    from . import cli, printer, storage, timing
+
+    for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+    for fd in fds:
+        if fd > 2:
+            os.close(fd)
+    reopen_stdio()
+    os.environ.clear()
+    os.environ.update(request["env"])
+    try:
+        os.chdir(request["cwd"])
+    except OSError:
+        pass
+    sys.argv = ["chatblade", *request["argv"]]
+    timing.ORIGIN = request.get("started", timing.ORIGIN)
+    # the terminal and environment of the client, not of the daemon
+    printer.console = Console()
+    storage._persisted.clear()
+    if storage.get_cache_path() == cache_path:
+
+        def write_behind(session, model, persisted):
+            line = json.dumps([session, model, persisted]) + "\n"
+            os.write(write_behind_fd, line.encode("utf-8"))
+
+        storage.write_behind = write_behind
+
+    try:
+        cli.cli()
+        code = 0
+    except SystemExit as e:
+        code = exit_code(e.code)
+    except KeyboardInterrupt:
+        code = 130
+    except EOFError:
+        code = 0
+    except Exception:
+        import traceback
+
+        traceback.print_exc()
+        code = 1
+    if timing.enabled():
+        timing.report()
+    for stream in (sys.stdout, sys.stderr):
+        try:
+            stream.flush()
+        except OSError:
+            pass
+    return code
+
+
+class Worker:
+    def __init__(self, pid, conn, pipe):
+        self.pid = pid
+        self.conn = conn
+        self.pipe = pipe
+        self.written = b""
+
+
+class Daemon:
+    """accepts invocations on the listening socket and forks their workers,
+    in a single thread so forking is safe"""
+
+    def __init__(self, listener):
+        import selectors
+
+        from . import storage
+
+        self.listener = listener
+        self.cache_path = storage.get_cache_path()
+        self.selector = selectors.DefaultSelector()
+        self.wakeup, self.wakeup_w = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.wakeup_w.setblocking(False)
+        self.workers = {}
+        self.pending = {}  # session: [model, persisted]
+        self.pending_since = None
+        self.stopping = False
+
+    def run(self):
+        import selectors
+        import signal
+
+        signal.set_wakeup_fd(self.wakeup_w.fileno())
+        signal.signal(signal.SIGCHLD, lambda *args: None)
+        signal.signal(signal.SIGTERM, lambda *args: self.stop())
+        self.selector.register(self.listener, selectors.EVENT_READ, self.accept)
+        self.selector.register(self.wakeup, selectors.EVENT_READ, self.reap)
+        while not (self.stopping and not self.workers):
+            timeout = None
+            if self.pending:
+                due = self.pending_since + FLUSH_MAX_DELAY - time.monotonic()
+                timeout = max(0, min(FLUSH_IDLE, due))
+            events = self.selector.select(timeout)
+            for key, _ in events:
+                key.data(key.fileobj)
+            if self.pending and (
+                not events
+                or time.monotonic() - self.pending_since >= FLUSH_MAX_DELAY
+            ):
+                self.flush()
+        self.flush()
+
+    def stop(self):
+        if not self.stopping:
+            self.stopping = True
+            self.selector.unregister(self.listener)
+            self.listener.close()
+
+    def accept(self, listener):
+        conn, _ = listener.accept()
+        conn.settimeout(5)
+        try:
+            if not same_user(conn):
+                raise PermissionError("connection of another user")
+            request, fds = receive_request(conn)
+        except (OSError, ValueError) as e:
+            log(f"refused a connection: {e!r}")
+            conn.close()
+            return
+        if request is None:
+            conn.close()
+            return
+        if request.get("stop"):
+            log("stopping")
+            self.stop()
+            conn.close()
+            return
+        if len(fds) != 3:
+            log("refused a request without its stdin, stdout and stderr")
+            conn.close()
+            return
+        self.fork(conn, request, fds)
+
+    def fork(self, conn, request, fds):
+        import functools
+        import selectors
+
+        pipe, pipe_w = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                self.close_in_worker()
+                os.close(pipe)
+                code = run_worker(request, fds, pipe_w, self.cache_path)
+            finally:
+                os._exit(code)
+        os.close(pipe_w)
+        for fd in fds:
+            os.close(fd)
+        worker = Worker(pid, conn, pipe)
+        self.workers[pid] = worker
+        conn.setblocking(False)
+        os.set_blocking(pipe, False)
+        self.selector.register(
+            conn, selectors.EVENT_READ, functools.partial(self.interrupt, worker)
+        )
+        self.selector.register(
+            pipe, selectors.EVENT_READ, functools.partial(self.read_pipe, worker)
+        )
+
+    def close_in_worker(self):
+        import signal
+
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        self.selector.close()
+        if not self.stopping:
+            self.listener.close()
+        self.wakeup.close()
+        self.wakeup_w.close()
+        for worker in self.workers.values():
+            worker.conn.close()
+            os.close(worker.pipe)
+
+    def interrupt(self, worker, conn):
+        """pass Ctrl-C on to the worker, and stop it if the client is gone"""
+        import signal
+
+        try:
+            data = conn.recv(16)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if data:
+            os.kill(worker.pid, signal.SIGINT)
+        else:
+            self.selector.unregister(conn)
+            os.kill(worker.pid, signal.SIGTERM)
+
+    def read_pipe(self, worker, pipe):
+        """collect the write-behind requests of the worker"""
+        try:
+            data = os.read(pipe, READ_SIZE)
+        except BlockingIOError:
+            return
+        if not data:
+            self.selector.unregister(pipe)
+        worker.written += data
+
+    def reap(self, wakeup):
+        while True:
+            try:
+                if not wakeup.recv(READ_SIZE):
+                    break
+            except BlockingIOError:
+                break
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if not pid:
+                break
+            worker = self.workers.pop(pid, None)
+            if worker:
+                self.finish(worker, status)
+
+    def finish(self, worker, status):
+        if os.WIFSIGNALED(status):
+            code = 128 + os.WTERMSIG(status)
+        else:
+            code = os.WEXITSTATUS(status)
+        while True:
+            try:
+                data = os.read(worker.pipe, READ_SIZE)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            worker.written += data
+        for fileobj in (worker.conn, worker.pipe):
+            try:
+                self.selector.unregister(fileobj)
+            except KeyError:
+                pass
+        os.close(worker.pipe)
+        try:
+            worker.conn.setblocking(True)
+            worker.conn.sendall(b"%d\n" % code)
+        except OSError:
+            pass
+        worker.conn.close()
+        for line in worker.written.decode("utf-8").splitlines():
+            session, model, persisted = json.loads(line)
+            if session in self.pending:
+                persisted = min(persisted, self.pending[session][1])
+            else:
+                self.pending_since = self.pending_since or time.monotonic()
+            self.pending[session] = [model, persisted]
+
+    def flush(self):
+        """sync the sessions the workers wrote and update their index and
+        token counts, keeping them in memory for the next invocations"""
+        from . import index, storage
+
+        for session, (model, persisted) in self.pending.items():
+            try:
+                session_path = storage.get_session_path(session, True)
+                if not session_path:
+                    continue
+                fd = os.open(session_path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                messages = storage.messages_from_cache(session)
+                storage.update_index(
+                    index.update_session, session, messages, persisted, model
+                )
+                storage.token_counts_to_cache(messages, session, persisted)
+            except Exception as e:
+                log(f"failed to write behind {session}: {e!r}")
+        self.pending = {}
+        self.pending_since = None
+
+
+def same_user(conn):
+    """whether the peer of conn is this user, where that can be told, the
+    socket is only accessible by the user anyway"""
+    if not hasattr(socket, "SO_PEERCRED"):
+        return True
+    import struct
+
+    credentials = conn.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+    )
+    _, uid, _ = struct.unpack("3i", credentials)
+    return uid == os.getuid()
+
+
+def serve():
+    """run the daemon until it is stopped with --daemon-stop or SIGTERM"""
+    import collections
+
+    from . import errors, storage
+
+    if not supported():
+        raise errors.ChatbladeError("the daemon needs unix sockets and fork")
+    path = get_socket_path()
+    sock = connect()
+    if sock:
+        sock.close()
+        raise errors.ChatbladeError("a daemon is already running")
+    if os.path.exists(path):
+        os.unlink(path)  # left behind by a daemon that didn't stop
+    started = time.perf_counter()
+    warm_up()
+    storage._hot = collections.OrderedDict()
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)
+    try:
+        listener.bind(path)
+    finally:
+        os.umask(umask)
+    listener.listen(64)
+    log(f"listening on {path}, ready in {time.perf_counter() - started:.1f}s")
+    try:
+        Daemon(listener).run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if os.path.exists(path):
+            os.unlink(path)
+    return 0
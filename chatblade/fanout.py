@@ -0,0 +1,92 @@
+"""
+Sends the same messages to several models concurrently. The answer of every
+model is stored in its own branch of the session, named <session>@<model>
+"""
+
+import concurrent.futures
+
+from . import chat, errors, storage, utils
+
+
+def branch_session(session, model):
+    return f"{session}@{model.replace('/', '_')}"
+
+
+def branch_messages(messages, session, model):
+    """the messages to send model: its branch continued with the new query
+    when the branch exists, else messages"""
+    history = storage.messages_from_cache(branch_session(session, model))
+    if not history:
+        return list(messages)
+    return history + messages[-1:]
+
+
+def query_model(messages, params, buffer):
+    """query one model, appending what it answers to buffer as it arrives"""
+    from . import context
+
+    messages = context.fit_messages(messages, params)
+    if params.cache:
+        from . import response_cache
+
+        result = response_cache.query_chat_gpt(messages, params)
+    else:
+        result = chat.query_chat_gpt(messages, params)
+    if isinstance(result, chat.MessageStream):
+        for delta in result:
+            buffer.append(delta)
+        return result.message
+    buffer.append(result.content)
+    return result
+
+
+def fetch_and_cache(messages, params):
+    """query all params.models at once and cache every answer in its branch
+    With a session the branches that exist are continued, the session itself
+    is left as it is. Returns {model: Message}, or the ChatbladeError for
+    models that failed"""
+    buffers = {model: [] for model in params.models}
+    session = params.session or utils.scratch_session
+    if params.session:
+        queried = {m: branch_messages(messages, session, m) for m in params.models}
+    else:  # a new conversation
+        queried = {model: list(messages) for model in params.models}
+    with concurrent.futures.ThreadPoolExecutor(len(params.models)) as pool:
+        futures = {
+            model: pool.submit(
+                query_model,
+                queried[model],
+                # the branch keeps its own summary when it is fitted
+                utils.DotDict(
+                    {
+                        **params,
+                        "model": model,
+                        "session": branch_session(session, model),
+                    }
+                ),
+                buffers[model],
+            )
+            for model in params.models
+        }
+        if params.stream and not params.extract:
+            from . import printer
+
+            with printer.MultiStreamPrinter(buffers) as stream_printer:
+                pending = set(futures.values())
+                while pending:
+                    _, pending = concurrent.futures.wait(
+                        pending, timeout=stream_printer.frame_time
+                    )
+                    stream_printer.render()
+
+    answers = {}
+    for model, future in futures.items():
+        try:
+            answers[model] = future.result()
+        except errors.ChatbladeError as e:
+            answers[model] = e
+            continue
+        storage.to_cache(
+            queried[model] + [answers[model]], branch_session(session, model), model
+        )
+    return answers
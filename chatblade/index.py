@@ -0,0 +1,318 @@
+"""
+Index of the sessions in the cache path, with the message count, token total,
+model and created/updated times of each, a full text index of their
+messages and a ledger of the tokens their answers used, in a sqlite database
+next to them
+
+storage.to_cache and renaming or deleting a session keep it up to date, so
+sessions can be listed, sorted, filtered and searched without opening their
+files. The full text index uses FTS5, or a plain table searched with LIKE
+when sqlite is built without it.
+Sessions whose file changed without the index being updated (written by an
+older chatblade, or while the index couldn't be written) are indexed again
+when listed.
+The ledger keeps the usage the API reported for each answer, by response
+id so saving a session again doesn't count it twice, and unlike the rest of
+the index it outlives the sessions, which are deleted or overwritten (last)
+"""
+
+import collections
+import contextlib
+import os
+import re
+import sqlite3
+import time
+
+from . import chat, storage, utils
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    name TEXT PRIMARY KEY,
+    messages INTEGER NOT NULL,
+    tokens INTEGER,
+    model TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+)
+"""
+
+# the same columns either way, only searching them differs
+MESSAGES_SCHEMA = """
+CREATE VIRTUAL TABLE messages USING fts5(
+    session UNINDEXED, position UNINDEXED, role UNINDEXED, content
+)
+"""
+
+MESSAGES_FALLBACK_SCHEMA = """
+CREATE TABLE messages (session TEXT, position INTEGER, role TEXT, content TEXT);
+CREATE INDEX messages_session ON messages (session, position);
+"""
+
+USAGE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    id TEXT PRIMARY KEY,
+    session TEXT NOT NULL,
+    model TEXT NOT NULL,
+    prompt_tokens INTEGER NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    created REAL NOT NULL
+)
+"""
+
+# bumped when the schema changes, the sessions are indexed again
+VERSION = 3
+
+SessionInfo = collections.namedtuple(
+    "SessionInfo", "name messages tokens model created updated"
+)
+
+SearchHit = collections.namedtuple("SearchHit", "session position role content")
+
+UsageTotal = collections.namedtuple(
+    "UsageTotal", "session model requests prompt_tokens completion_tokens"
+)
+
+SORT_KEYS = ["name", "created", "updated", "messages", "tokens"]
+
+
+def get_index_path():
+    return os.path.join(storage.get_cache_path(), "index.sqlite3")
+
+
+@contextlib.contextmanager
+def connect():
+    """a connection to the index, committed when the block completes"""
+    connection = sqlite3.connect(get_index_path(), timeout=10)
+    try:
+        # readers don't block the writer of another chatblade process
+        connection.execute("PRAGMA journal_mode=WAL")
+        with connection:
+            if connection.execute("PRAGMA user_version").fetchone()[0] < VERSION:
+                upgrade(connection)
+            yield connection
+    finally:
+        connection.close()
+
+
+def upgrade(connection):
+    connection.execute("DROP TABLE IF EXISTS sessions")
+    connection.execute("DROP TABLE IF EXISTS messages")
+    connection.execute(SCHEMA)
+    try:
+        connection.execute(MESSAGES_SCHEMA)
+    except sqlite3.OperationalError:  # no fts5
+        connection.executescript(MESSAGES_FALLBACK_SCHEMA)
+    # the ledger is kept, it can't be rebuilt from the sessions
+    connection.execute(USAGE_SCHEMA)
+    connection.execute(f"PRAGMA user_version = {VERSION}")
+
+
+def has_fts(connection):
+    (sql,) = connection.execute(
+        "SELECT sql FROM sqlite_master WHERE name = 'messages'"
+    ).fetchone()
+    return "fts5" in sql
+
+
+def count_tokens(messages, model):
+    """the tokens in messages, None if they can't be counted (the encoding
+    may need to be downloaded), that doesn't keep them from being indexed"""
+    try:
+        encoding = chat.get_encoding(model)
+        return sum(chat.message_token_counts(messages, encoding))
+    except Exception as e:
+        utils.debug(title="session index", error=repr(e))
+        return None
+
+
+def update_session(session, messages, persisted=0, model=None):
+    """index session after its messages were written, persisted of them
+    were in the file before and already counted if the index is up to date"""
+    with connect() as connection:
+        index_session(connection, session, messages, persisted, model)
+
+
+def index_session(connection, session, messages, persisted=0, model=None):
+    stat = os.stat(storage.get_session_path(session))
+    row = connection.execute(
+        "SELECT messages, tokens, model, created FROM sessions WHERE name = ?",
+        (session,),
+    ).fetchone()
+    model = model or (row[2] if row else None)
+    if not (row and persisted and row[0] == persisted):
+        persisted = 0  # the index is behind, index all messages again
+        connection.execute("DELETE FROM messages WHERE session = ?", (session,))
+    connection.executemany(
+        "INSERT INTO messages VALUES (?, ?, ?, ?)",
+        [
+            (session, position, message.role, message.content)
+            for position, message in enumerate(messages[persisted:], persisted)
+        ],
+    )
+    connection.executemany(
+        "INSERT OR IGNORE INTO usage VALUES (?, ?, ?, ?, ?, ?)",
+        [
+            (
+                message.usage.id,
+                session,
+                message.usage.model,
+                message.usage.prompt_tokens,
+                message.usage.completion_tokens,
+                stat.st_mtime,
+            )
+            for message in messages[persisted:]
+            if message.usage
+        ],
+    )
+    if persisted and row[1] is not None:
+        tokens = count_tokens(messages[persisted:], model)
+        if tokens is not None:
+            tokens += row[1]
+    else:
+        tokens = count_tokens(messages, model)
+    connection.execute(
+        "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            session,
+            len(messages),
+            tokens,
+            model,
+            row[3] if row else stat.st_mtime,
+            stat.st_mtime,
+            stat.st_size,
+            stat.st_mtime_ns,
+        ),
+    )
+
+
+def rename_session(session, newname):
+    with connect() as connection:
+        connection.execute("DELETE FROM sessions WHERE name = ?", (newname,))
+        connection.execute(
+            "UPDATE sessions SET name = ? WHERE name = ?", (newname, session)
+        )
+        connection.execute("DELETE FROM messages WHERE session = ?", (newname,))
+        connection.execute(
+            "UPDATE messages SET session = ? WHERE session = ?", (newname, session)
+        )
+        connection.execute(
+            "UPDATE usage SET session = ? WHERE session = ?", (newname, session)
+        )
+
+
+def delete_session(session):
+    with connect() as connection:
+        connection.execute("DELETE FROM sessions WHERE name = ?", (session,))
+        connection.execute("DELETE FROM messages WHERE session = ?", (session,))
+
+
+def sync(connection):
+    """index the sessions whose file changed since they were indexed and
+    drop the ones that no longer exist"""
+    from . import session
+
+    indexed = {
+        name: (size, mtime_ns)
+        for name, size, mtime_ns in connection.execute(
+            "SELECT name, size, mtime_ns FROM sessions"
+        )
+    }
+    for name in session.list_sessions():
+        stat = indexed.pop(name, None)
+        session_path = storage.get_session_path(name, True)  # migrates yaml
+        if not session_path:
+            continue
+        current = os.stat(session_path)
+        if stat != (current.st_size, current.st_mtime_ns):
+            index_session(connection, name, storage.messages_from_cache(name))
+    connection.executemany(
+        "DELETE FROM sessions WHERE name = ?", [(name,) for name in indexed]
+    )
+    connection.executemany(
+        "DELETE FROM messages WHERE session = ?", [(name,) for name in indexed]
+    )
+
+
+def list_sessions(sort="name", prefix=None, max_age=None, min_tokens=None):
+    """the SessionInfo of the sessions, sorted by name or else newest or
+    largest first, with a name starting with prefix, updated in the last
+    max_age days and holding at least min_tokens tokens"""
+    if sort not in SORT_KEYS:
+        raise ValueError(f"unknown sort key: {sort}")
+    conditions = []
+    args = []
+    if prefix:
+        conditions.append("substr(name, 1, ?) = ?")
+        args += [len(prefix), prefix]
+    if max_age is not None:
+        conditions.append("updated >= ?")
+        args.append(time.time() - max_age * 24 * 3600)
+    if min_tokens:
+        conditions.append("tokens >= ?")
+        args.append(min_tokens)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    order = "name" if sort == "name" else f"{sort} DESC, name"
+    with connect() as connection:
+        sync(connection)
+        rows = connection.execute(
+            f"SELECT {', '.join(SessionInfo._fields)} FROM sessions {where}"
+            f" ORDER BY {order}",
+            args,
+        ).fetchall()
+    return [SessionInfo(*row) for row in rows]
+
+
+def search(terms, session=None, limit=10):
+    """the SearchHits of the messages holding all terms, best matches first
+    with fts5 and newest first without, in session if given"""
+    words = terms.split()
+    if not words:
+        return []
+    with connect() as connection:
+        sync(connection)
+        if has_fts(connection):
+            # quoted, so the words are searched for and not read as fts5 syntax
+            match = " ".join('"' + word.replace('"', '""') + '"' for word in words)
+            conditions = ["messages MATCH ?"]
+            args = [match]
+            order = "rank"
+        else:
+            conditions = ["content LIKE ? ESCAPE '\\'"] * len(words)
+            args = [
+                "%" + re.sub(r"([%_\\])", r"\\\1", word) + "%" for word in words
+            ]
+            order = "rowid DESC"
+        if session:
+            conditions.append("session = ?")
+            args.append(session)
+        rows = connection.execute(
+            f"SELECT {', '.join(SearchHit._fields)} FROM messages"
+            f" WHERE {' AND '.join(conditions)} ORDER BY {order} LIMIT ?",
+            args + [limit],
+        ).fetchall()
+    return [SearchHit(*row) for row in rows]
+
+
+def usage_totals(session=None, max_age=None):
+    """the UsageTotals of the ledger by session and model, of session if
+    given and of the answers in the last max_age days"""
+    conditions = []
+    args = []
+    if session:
+        conditions.append("session = ?")
+        args.append(session)
+    if max_age is not None:
+        conditions.append("created >= ?")
+        args.append(time.time() - max_age * 24 * 3600)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    with connect() as connection:
+        sync(connection)
+        rows = connection.execute(
+            "SELECT session, model, count(*), sum(prompt_tokens),"
+            f" sum(completion_tokens) FROM usage {where}"
+            " GROUP BY session, model ORDER BY session, model",
+            args,
+        ).fetchall()
+    return [UsageTotal(*row) for row in rows]
@@ -0,0 +1,196 @@
+"""
+Runs a query over piped input too large to send in a single request
+
+The input is read in chunks of at most --chunk-tokens tokens and the query
+is run over the chunks concurrently (map). The answers are then combined
+with the reduce prompt, in rounds until a single answer is left (reduce).
+Only the chunks in flight are kept in memory, not the input
+"""
+
+import asyncio
+import sys
+
+from . import chat, errors, storage, utils
+
+READ_SIZE = 64 * 1024
+
+# as parser.extract_query puts piped input above the query
+SEPARATOR = "\n----------------\n"
+
+REDUCE_PROMPT = """Each answer above answers the query below for one part of a
+larger input, in the order of the input. Combine them into a single answer to
+the query for the whole input.
+
+Query: {query}"""
+
+
+def read_pieces(f):
+    """the lines of f, long lines in pieces of at most READ_SIZE characters"""
+    return iter(lambda: f.readline(READ_SIZE), "")
+
+
+def split_chunks(pieces, encoding, max_tokens):
+    """joins pieces of text into chunks of at most max_tokens tokens,
+    splitting pieces that don't fit a chunk by themselves"""
+    chunk = []
+    chunk_tokens = 0
+    for piece in pieces:
+        tokens = encoding.encode(piece, disallowed_special=())
+        if chunk and chunk_tokens + len(tokens) > max_tokens:
+            yield "".join(chunk)
+            chunk = []
+            chunk_tokens = 0
+        if len(tokens) > max_tokens:
+            for start in range(0, len(tokens) - max_tokens, max_tokens):
+                yield encoding.decode(tokens[start : start + max_tokens])
+            tokens = tokens[start + max_tokens :]
+            piece = encoding.decode(tokens)
+        chunk.append(piece)
+        chunk_tokens += len(tokens)
+    if chunk:
+        yield "".join(chunk)
+
+
+def group_answers(answers, encoding, max_tokens):
+    """the answers in groups to reduce, of at most max_tokens tokens unless
+    that leaves answers on their own, each group holds at least two"""
+    groups = [[]]
+    group_tokens = 0
+    for answer in answers:
+        # and about 8 for its "Answer n:" label
+        tokens = len(encoding.encode(answer, disallowed_special=())) + 8
+        if len(groups[-1]) > 1 and group_tokens + tokens > max_tokens:
+            groups.append([])
+            group_tokens = 0
+        groups[-1].append(answer)
+        group_tokens += tokens
+    if len(groups) > 1 and len(groups[-1]) == 1:
+        groups[-2] += groups.pop()
+    return groups
+
+
+def reduce_query(answers, query, reduce_prompt):
+    numbered = [f"Answer {i}:\n{answer}" for i, answer in enumerate(answers, 1)]
+    prompt = (reduce_prompt or REDUCE_PROMPT).replace("{query}", query)
+    return "\n\n".join(numbered) + SEPARATOR + prompt
+
+
+class Progress:
+    """reports the chunks answered by each stage on stderr, on a terminal"""
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.sent = 0
+        self.answered = 0
+        self.enabled = sys.stderr.isatty()
+
+    def update(self, sent=0, answered=0):
+        self.sent += sent
+        self.answered += answered
+        if self.enabled:
+            sys.stderr.write(
+                f"\r{self.stage}: {self.answered}/{self.sent} chunks answered"
+            )
+            sys.stderr.flush()
+
+    def done(self):
+        if self.enabled:
+            sys.stderr.write("\n")
+
+
+async def ask(query, params, init_msgs):
+    messages = chat.init_conversation(query, *init_msgs)
+    return await chat.query_chat_gpt_async(messages, params)
+
+
+async def run_stage(queries, params, init_msgs, progress):
+    """ask the queries, read from an iterator that may block, with at most
+    params.map_concurrency in flight. Returns the answer Messages in order"""
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(params.map_concurrency)
+    tasks = []
+    failed = False
+
+    def on_done(task):
+        nonlocal failed
+        slots.release()
+        progress.update(answered=1)
+        if task.cancelled() or task.exception():
+            failed = True
+
+    while not failed:
+        await slots.acquire()
+        # reading and encoding the input blocks, keep it off the loop
+        query = await loop.run_in_executor(None, next, queries, None)
+        if query is None:
+            slots.release()
+            break
+        task = asyncio.ensure_future(ask(query, params, init_msgs))
+        task.add_done_callback(on_done)
+        tasks.append(task)
+        progress.update(sent=1)
+
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        progress.done()
+
+
+def total_usage(usages):
+    """the Usage of all the requests, of the last one's response id and
+    model, None unless all of them reported theirs"""
+    if not usages or not all(usages):
+        return None
+    return chat.Usage(
+        usages[-1].id,
+        usages[-1].model,
+        sum(usage.prompt_tokens for usage in usages),
+        sum(usage.completion_tokens for usage in usages),
+    )
+
+
+async def map_reduce(pieces, query, params, init_msgs):
+    """the answer Message, with the usage of all the map and reduce requests"""
+    encoding = chat.get_encoding(params.model)
+    chunks = split_chunks(pieces, encoding, params.chunk_tokens)
+    map_queries = (chunk + SEPARATOR + query for chunk in chunks)
+    responses = await run_stage(map_queries, params, init_msgs, Progress("map"))
+    if not responses:
+        raise errors.ChatbladeError("no input to map")
+    usages = [response.usage for response in responses]
+
+    rounds = 0
+    while len(responses) > 1:
+        rounds += 1
+        answers = [response.content for response in responses]
+        groups = group_answers(answers, encoding, params.chunk_tokens)
+        reduce_queries = iter(
+            [reduce_query(group, query, params.reduce_prompt) for group in groups]
+        )
+        responses = await run_stage(
+            reduce_queries, params, init_msgs, Progress(f"reduce {rounds}")
+        )
+        usages += [response.usage for response in responses]
+    return chat.Message("assistant", responses[0].content, total_usage(usages))
+
+
+def run(query, params):
+    """answer query over the piped input and print the answer"""
+    from . import printer
+
+    if sys.stdin.isatty():
+        raise errors.ChatbladeError("map-reduce needs piped input")
+    if not query:
+        raise errors.ChatbladeError("map-reduce needs a query to run over the input")
+    init_msgs = (
+        [storage.load_prompt_file(params.prompt_file)] if params.prompt_file else []
+    )
+    answer = asyncio.run(
+        map_reduce(read_pieces(sys.stdin), query, params, init_msgs)
+    )
+    messages = chat.init_conversation(query, *init_msgs)
+    messages.append(answer)
+    storage.to_cache(messages, params.session or utils.scratch_session, params.model)
+    printer.print_messages(messages, params)
@@ -34,18 +34,27 @@ model_mappings = {
 DEFAULT_MODEL = "mini"
 
 
-def get_openai_model(options):
-    choice = options["chat_gpt"]
-    if not choice:
+def get_openai_models(options):
+    """the models chosen with -c, which can be repeated or given as a
+    comma separated list"""
+    choices = [
+        choice.strip()
+        for arg in options["chat_gpt"] or []
+        for choice in arg.split(",")
+        if choice.strip()
+    ]
+    if not choices:
         if "OPENAI_API_MODEL" in os.environ:
-            choice = os.environ["OPENAI_API_MODEL"]
+            choices = [os.environ["OPENAI_API_MODEL"]]
         else:
-            choice = DEFAULT_MODEL
+            choices = [DEFAULT_MODEL]
 
-    if choice in model_mappings:
-        return model_mappings[choice]
-    else:
-        return choice
+    models = [model_mappings.get(choice, choice) for choice in choices]
+    return list(dict.fromkeys(models))  # without duplicates, in order
+
+
+def get_openai_model(options):
+    return get_openai_models(options)[0]
 
 
 def get_theme(options):
@@ -78,7 +87,8 @@ def extract_options(options):
     options = vars(options)  # to map
     options["openai_api_key"] = get_openai_key(options)
     options["theme"] = get_theme(options)
-    options["model"] = get_openai_model(options)
+    options["models"] = get_openai_models(options)
+    options["model"] = options["models"][0]
     del options["query"]
     del options["chat_gpt"]
     return utils.DotDict(options)
@@ -91,6 +101,42 @@ def valid_session(sess):
         raise argparse.ArgumentTypeError(f"invalid session name {sess}")
 
 
+def message_range(value):
+    """a from:to range of messages, counting from 1 and including to, either
+    may be left out. Returns the (start, stop) of the slice of messages"""
+    start, sep, stop = value.partition(":")
+    try:
+        start = int(start) if start else 1
+        stop = int(stop) if stop else None
+    except ValueError:
+        start = 0
+    if not sep:
+        stop = start
+    if start < 1 or (stop is not None and stop < start):
+        raise argparse.ArgumentTypeError(f"expected a range like 3:7, got {value}")
+    return start - 1, stop
+
+
+def positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"expected a positive number, got {value}")
+    return number
+
+
+def non_negative_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        number = -1
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"expected a non-negative number, got {value}")
+    return number
+
+
 class RenameAction(argparse.Action):
     def __call__(self, parser, namespace, values, option_string=None):
         namespace.session_op = "rename"
@@ -130,13 +176,55 @@ def parse(args):
         help="temperature (openai setting)",
         default=0.0,
     )
+    parser.add_argument(
+        "--cache",
+        help="answer identical queries (same model, messages and settings) from a local cache",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        metavar="hours",
+        type=float,
+        help="how long cached responses are used (default 168)",
+    )
+    parser.add_argument(
+        "--rpm",
+        metavar="n",
+        type=positive_int,
+        help="limit requests per minute to the model, shared by all running chatblade processes",
+    )
+    parser.add_argument(
+        "--tpm",
+        metavar="n",
+        type=positive_int,
+        help="limit (estimated prompt) tokens per minute to the model, shared like --rpm",
+    )
+    parser.add_argument(
+        "--retries",
+        metavar="n",
+        type=non_negative_int,
+        help="how often to retry rate limited, server and connection errors (default 3)",
+    )
+    parser.add_argument(
+        "--context-tokens",
+        metavar="n",
+        type=positive_int,
+        help="token budget for the messages sent, older turns are left out beyond it (default: the model's context window minus room for the answer)",
+    )
+    parser.add_argument(
+        "--context-summarize",
+        help="fold the turns left out of the context into a summary instead of dropping them",
+        action="store_true",
+    )
     parser.add_argument(
         "-c",
         "--chat-gpt",
         help=f"""chat GPT model use either the fully qualified model name, or
-        {model_mappings_str}. Can also be set via env variable OPENAI_API_MODEL
+        {model_mappings_str}. Can also be set via env variable OPENAI_API_MODEL.
+        Several models (repeated or comma separated) are queried concurrently
         """,
         type=str,
+        action="append",
     )
     parser.add_argument(
         "-i",
@@ -144,6 +232,11 @@ def parse(args):
         help="start an interactive chat session. This will implicitly continue the conversation",
         action="store_true",
     )
+    parser.add_argument(
+        "--no-warm-up",
+        help="don't open a connection to the API while the next interactive query is typed",
+        action="store_true",
+    )
     parser.add_argument(
         "-s",
         "--stream",
@@ -194,6 +287,24 @@ def parse(args):
         help="Only display the response, omit query",
         action="store_true",
     )
+    selection_opts = display_opts.add_mutually_exclusive_group()
+    selection_opts.add_argument(
+        "--tail",
+        metavar="n",
+        type=positive_int,
+        help="only print the last n messages of the session",
+    )
+    selection_opts.add_argument(
+        "--range",
+        metavar="from:to",
+        type=message_range,
+        help="only print messages from to to of the session, counting from 1, e.g. 3:7, 10: or :5",
+    )
+    display_opts.add_argument(
+        "--pager",
+        action="store_true",
+        help="page the output, messages are formatted as they are paged to (PAGER, default less)",
+    )
     display_opts.add_argument(
         "--theme",
         metavar="theme",
@@ -224,6 +335,52 @@ def parse(args):
         const="list",
         help="list sessions",
     )
+    session_opts.add_argument(
+        "--session-sort",
+        choices=["name", "created", "updated", "messages", "tokens"],
+        default="name",
+        help="sort --session-list by name, or newest or largest first (default name)",
+    )
+    session_opts.add_argument(
+        "--session-prefix",
+        metavar="prefix",
+        type=str,
+        help="only list sessions whose name starts with prefix",
+    )
+    session_opts.add_argument(
+        "--session-max-age",
+        metavar="days",
+        type=float,
+        help="only list sessions updated, or count usage recorded, in the last days",
+    )
+    session_opts.add_argument(
+        "--session-min-tokens",
+        metavar="tokens",
+        type=positive_int,
+        help="only list sessions holding at least tokens",
+    )
+    session_opts.add_argument(
+        "--session-search",
+        metavar="terms",
+        type=str,
+        help="""search the messages of all sessions (or of the session given with
+        -S) for the terms, and print the best matches""",
+    )
+    session_opts.add_argument(
+        "--session-search-limit",
+        metavar="n",
+        type=positive_int,
+        default=10,
+        help="maximum number of matches --session-search prints (default 10)",
+    )
+    session_opts.add_argument(
+        "--session-usage",
+        dest="session_op",
+        action="store_const",
+        const="usage",
+        help="""show the tokens and costs the API reported for the answers of all
+        sessions (or of the session given with -S), by session and model""",
+    )
     session_opts.add_argument(
         "--session-path",
         dest="session_op",
@@ -253,8 +410,89 @@ def parse(args):
         help="rename session",
     )
 
+    batch_opts = parser.add_argument_group("batch options")
+    batch_opts.add_argument(
+        "--batch",
+        metavar="file",
+        type=str,
+        help="""run the queries in a file (- for stdin) of JSON lines, each a query
+        string or an object with a query and optional session, prompt_file and model.
+        Results are written as JSON lines""",
+    )
+    batch_opts.add_argument(
+        "--batch-concurrency",
+        metavar="n",
+        type=positive_int,
+        default=8,
+        help="maximum number of batch queries in flight (default 8)",
+    )
+    batch_opts.add_argument(
+        "--batch-order",
+        choices=["input", "completion"],
+        default="input",
+        help="write batch results in input order or as they complete (default input)",
+    )
+
+    map_reduce_opts = parser.add_argument_group("map-reduce options")
+    map_reduce_opts.add_argument(
+        "--map-reduce",
+        action="store_true",
+        help="""run the query over chunks of piped input too large for a single
+        request, concurrently, then combine the answers into one""",
+    )
+    map_reduce_opts.add_argument(
+        "--chunk-tokens",
+        metavar="tokens",
+        type=positive_int,
+        default=4000,
+        help="maximum tokens of input in a chunk (default 4000)",
+    )
+    map_reduce_opts.add_argument(
+        "--map-concurrency",
+        metavar="n",
+        type=positive_int,
+        default=8,
+        help="maximum number of chunks in flight (default 8)",
+    )
+    map_reduce_opts.add_argument(
+        "--reduce-prompt",
+        metavar="prompt",
+        type=str,
+        help="prompt that combines the answers, {query} is replaced by the query",
+    )
+
+    daemon_opts = parser.add_argument_group("daemon options")
+    daemon_opts.add_argument(
+        "--daemon",
+        action="store_true",
+        help="""run in the foreground as a daemon that later chatblade commands run
+        in, with imports, tokenizers and sessions loaded already""",
+    )
+    daemon_opts.add_argument(
+        "--daemon-stop",
+        action="store_true",
+        help="stop the running daemon",
+    )
+
+    parser.add_argument(
+        "--profile",
+        help="report how long startup, the request, the first token, streaming, rendering and saving took, on stderr",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--profile-file",
+        metavar="file",
+        type=str,
+        help="append the --profile timings to file instead, as a json object per run",
+    )
+
     # --- debug
     parser.add_argument("--debug", action="store_true", help=argparse.SUPPRESS)
 
     options = parser.parse_args(args)
+    if options.batch:  # the queries come from the batch, stdin may hold it
+        return None, extract_options(options)
+    if options.map_reduce:  # the piped input is read in chunks
+        query = " ".join(options.query) if options.query else None
+        return query, extract_options(options)
     return extract_query(options.query), extract_options(options)
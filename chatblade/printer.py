@@ -1,15 +1,24 @@
+import collections
+import contextlib
+import functools
+import itertools
 import json
+import os
 import re
+import subprocess
 import sys
+import time
 import rich
 from rich.console import Console
 from rich.json import JSON
+from rich.live import Live
 from rich.markdown import Markdown
 from rich.table import Table
 from rich.rule import Rule
+from rich.segment import Segments
+from rich.text import Text
 
-from chatblade import utils
-from pylatexenc.latex2text import LatexNodes2Text
+from chatblade import chat, utils
 
 
 console = Console()
@@ -19,6 +28,44 @@ def warn(msg):
     rich.print(f"[red]{msg}[/red]", file=sys.stderr)
 
 
+@contextlib.contextmanager
+def paged(enabled=True):
+    """print through the pager (PAGER, default less) in the block, if enabled
+    and printing to a terminal. Writing to the pager blocks while it doesn't
+    read any more, so only what is paged to is formatted"""
+    global console
+    if not enabled or not console.is_terminal:
+        yield
+        return
+    env = dict(os.environ)
+    env.setdefault("LESS", "FRX")  # keep colors, quit if it fits on a screen
+    pager = subprocess.Popen(
+        os.environ.get("PAGER") or "less",
+        shell=True,
+        stdin=subprocess.PIPE,
+        env=env,
+        encoding="utf-8",
+    )
+    screen = console
+    console = Console(
+        file=pager.stdin,
+        force_terminal=True,
+        width=screen.width,
+        color_system=screen.color_system,
+    )
+    try:
+        yield
+    except BrokenPipeError:
+        pass  # the pager quit before everything was printed
+    finally:
+        console = screen
+        try:
+            pager.stdin.close()
+        except BrokenPipeError:
+            pass
+        pager.wait()
+
+
 def print_tokens(messages, token_stats, args):
     if args.only:
       args.roles = ["assistant"]
@@ -42,6 +89,31 @@ def print_tokens(messages, token_stats, args):
     )
 
 
+def print_usage(messages, usage_stats, args):
+    if args.only:
+      args.roles = ["assistant"]
+    else:
+      args.roles = ["user", "assistant", "system"]
+    print_messages(messages, args)
+    console.print()
+    table = Table(title="usage/costs")
+    table.add_column("Model", no_wrap=True)
+    table.add_column("Answers", justify="right")
+    table.add_column("Prompt tokens", justify="right")
+    table.add_column("Completion tokens", justify="right")
+    table.add_column("Price", style="bold", justify="right")
+    for usage_stat in usage_stats:
+        table.add_row(
+            usage_stat.name,
+            str(usage_stat.requests),
+            "{:d}".format(usage_stat.prompt_tokens),
+            "{:d}".format(usage_stat.completion_tokens),
+            "?" if usage_stat.cost is None else "${:.6f}".format(usage_stat.cost),
+        )
+    console.print(table)
+    console.print("[red] * as reported by the API for the answers[/red]")
+
+
 def print_messages(messages, args):
     if "roles" not in args:
       if args.only:
@@ -59,17 +131,17 @@ def print_messages(messages, args):
 COLORS = {"user": "blue", "assistant": "green", "system": "red"}
 
 
-def print_message(message, args):
+def print_message(message, args, title=None):
     printable = message.content
     if not args.raw:
         printable = detect_and_format_message(
             message.content, cutoff=1000 if message.role == "user" else None, theme=args.theme
         )
     if not args.no_format:
-      console.print(Rule(message.role, style=COLORS[message.role]))
+      console.print(Rule(title or message.role, style=COLORS[message.role]))
 
     if args.raw:
-        print(message.content)
+        print(message.content, file=console.file)
     else:
         console.print(printable)
 
@@ -77,16 +149,314 @@ def print_message(message, args):
       console.print(Rule(style=COLORS[message.role]))
 
 
+# a line that keeps a list going after a blank line
+BLOCK_GOES_ON = re.compile(r"[^\S\n]|[-*+][^\S\n]|\d{1,9}[.)][^\S\n]")
+
+
+class StreamPrinter:
+    """prints a streamed message while it arrives
+
+    Completed blocks (separated by a blank line outside of code fences that
+    doesn't go on with a list) are classified as they complete, with the
+    markdown signals of the answer so far. Once it is markdown they are
+    printed as markdown, once, until then they are held and shown as plain
+    text with the open block at the end, which is redrawn. An answer that
+    doesn't turn out to be markdown is printed as a whole when it is complete.
+    Redraws are coalesced to refresh_per_second"""
+
+    def __init__(self, args, role="assistant", refresh_per_second=10):
+        self.args = args
+        self.role = role
+        self.frame_time = 1 / refresh_per_second
+        self.live = None
+        self.pending = []
+        self.tail = ""
+        self.scanned = 0
+        self.in_fence = False
+        self.blocks = 0
+        self.after_rule = False  # the last block printed ends with a rule
+        self.held = []  # completed blocks, until the answer is markdown
+        self.held_lines = collections.deque(maxlen=max(console.height, 1))
+        self.score = 0
+        self.markdown = False
+        self.last_frame = 0
+        self.deltas = 0
+        self.render_time = 0
+
+    def __enter__(self):
+        if not self.args.no_format:
+            console.print(Rule(self.role, style=COLORS[self.role]))
+        if not self.args.raw:
+            self.live = Live(
+                Text(""), console=console, auto_refresh=False, transient=True
+            )
+            self.live.start()
+        return self
+
+    def update(self, delta):
+        self.deltas += 1
+        if self.args.raw:
+            console.file.write(delta)
+            console.file.flush()
+        else:
+            self.pending.append(delta)
+            if time.perf_counter() - self.last_frame >= self.frame_time:
+                self.render()
+
+    def __exit__(self, *exc):
+        if self.args.raw:
+            console.file.write("\n")
+        else:
+            self.render(final=True)
+            self.live.stop()
+        if not self.args.no_format:
+            console.print(Rule(style=COLORS[self.role]))
+        utils.debug(
+            title="stream rendering",
+            deltas=self.deltas,
+            render_ms=round(self.render_time * 1000, 2),
+            render_us_per_delta=round(self.render_time * 1e6 / (self.deltas or 1), 2),
+        )
+
+    def render(self, final=False):
+        start = time.perf_counter()
+        self.tail += "".join(self.pending)
+        self.pending.clear()
+        for block in self.completed_blocks():
+            self.add_block(block)
+        if final:
+            if self.tail.strip():
+                self.add_block(self.tail)
+            if self.held:
+                self.print_held()
+            self.live.update(Text(""), refresh=True)
+        else:
+            # only the lines that fit on the screen are worth drawing
+            lines = list(self.held_lines) + self.tail.split("\n")
+            lines = lines[-max(console.height - 2, 1) :]
+            self.live.update(Text("\n".join(lines)), refresh=True)
+        self.last_frame = time.perf_counter()
+        self.render_time += self.last_frame - start
+
+    def completed_blocks(self):
+        """split completed blocks off the tail, scanning every line once"""
+        while True:
+            end = self.tail.find("\n", self.scanned)
+            if end == -1:
+                return
+            line = self.tail[self.scanned : end]
+            if line.lstrip().startswith("```"):
+                self.in_fence = not self.in_fence
+            elif not line.strip() and not self.in_fence and self.tail[:end].strip():
+                following = self.tail.find("\n", end + 1)
+                if following == -1:
+                    return  # the next line decides whether the block goes on
+                if not BLOCK_GOES_ON.match(self.tail, end + 1, following):
+                    yield self.tail[:end]
+                    self.tail = self.tail[end + 1 :]
+                    self.scanned = 0
+                    continue
+            self.scanned = end + 1
+
+    def add_block(self, block):
+        block = block.strip("\n")
+        if self.markdown:
+            self.print_markdown(block)
+            return
+        # after the blank line it follows, as in the answer
+        signals = classify("\n" + block).signals
+        if signals:  # the signals of blocks add up, none span blocks
+            self.score += sum(signals.values()) + signals["md_blocks"]
+        self.held.append(block)
+        if self.score >= 2:
+            self.markdown = True
+            held, self.held = self.held, []
+            self.held_lines.clear()
+            for block in held:
+                self.add_block(block)
+        else:
+            if self.held_lines:
+                self.held_lines.append("")
+            self.held_lines.extend(block.split("\n"))
+
+    def print_held(self):
+        """the answer, complete and not markdown: json or plain text"""
+        printable = detect_and_format_message(
+            "\n\n".join(self.held), theme=self.args.theme
+        )
+        if isinstance(printable, str):
+            printable = Text(printable)
+        self.held = []
+        self.print_block(printable)
+
+    def print_markdown(self, block):
+        """print block spaced from the blocks before it as rich spaces the
+        elements of the whole answer: it is rendered after a line standing in
+        for the previous block, which is dropped"""
+        block = format_latex(block)
+        if self.blocks:
+            before = "---" if self.after_rule else "x"
+            markdown = Markdown(f"{before}\n\n{block}", code_theme=self.theme)
+            lines = self.live.console.render_lines(markdown, new_lines=True)
+            printable = Segments(itertools.chain.from_iterable(lines[1:]))
+        else:
+            markdown = printable = Markdown(block, code_theme=self.theme)
+        self.print_block(printable)
+        top_level = [token.type for token in markdown.parsed if token.level == 0]
+        self.after_rule = top_level[-1:] == ["hr"]
+
+    def print_block(self, printable):
+        self.live.console.print(printable)
+        self.blocks += 1
+
+    @property
+    def theme(self):
+        return "monokai" if self.args.theme is None else self.args.theme
+
+
+class MultiStreamPrinter:
+    """shows the end of several streamed answers while they arrive, side by
+    side when the terminal is wide enough and one below the other if not.
+    buffers maps a label to the list the deltas of its answer are appended to"""
+
+    MIN_COLUMN_WIDTH = 40
+
+    def __init__(self, buffers, refresh_per_second=10):
+        self.buffers = buffers
+        self.frame_time = 1 / refresh_per_second
+        self.texts = {label: "" for label in buffers}
+        self.consumed = {label: 0 for label in buffers}
+        self.live = Live(Text(""), console=console, auto_refresh=False, transient=True)
+
+    def __enter__(self):
+        self.live.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.live.stop()
+
+    def render(self):
+        for label, buffer in self.buffers.items():
+            count = len(buffer)  # the buffers are appended to concurrently
+            self.texts[label] += "".join(buffer[self.consumed[label] : count])
+            self.consumed[label] = count
+        self.live.update(self.view(), refresh=True)
+
+    def view(self):
+        from rich.console import Group
+        from rich.panel import Panel
+
+        side_by_side = console.width // len(self.texts) >= self.MIN_COLUMN_WIDTH
+        if side_by_side:
+            lines = console.height - 2
+        else:
+            lines = max(console.height // len(self.texts) - 2, 1)
+        panels = [
+            Panel(
+                Text("\n".join(text.split("\n")[-lines:])),
+                title=label,
+                height=lines + 2,
+            )
+            for label, text in self.texts.items()
+        ]
+        if not side_by_side:
+            return Group(*panels)
+        grid = Table.grid(expand=True)
+        for _ in panels:
+            grid.add_column(ratio=1)
+        grid.add_row(*panels)
+        return grid
+
+
+def print_answers(answers, args):
+    """prints the answers of several models, each labeled with its model"""
+    for model, answer in answers.items():
+        if isinstance(answer, Exception):
+            warn(f"{model}: {answer}")
+        elif args.extract:
+            if not args.no_format:
+                console.print(Rule(model, style=COLORS[answer.role]))
+            print(extract_content(answer.content))
+        else:
+            print_message(answer, args, title=f"{answer.role} ({model})")
+
+
+def print_extracted_stream(stream):
+    """prints the json documents of a streamed message as soon as each one is
+    complete, or what extract_content finds once the message is complete"""
+    extractor = JsonExtractor()
+    printed = False
+    for delta in stream:
+        for value in extractor.feed(delta):
+            print(json.dumps(value), flush=True)
+            printed = True
+    for value in extractor.close():
+        print(json.dumps(value))
+        printed = True
+    if not printed:
+        print(extract_content(stream.message.content))
+
+
 def extract_messages(messages, args):
-    message = messages[-1]
-    if contains_json(message.content):
-        print(extract_json(message.content))
-    elif contains_block(message.content):
-        print(extract_block(message.content))
+    print(extract_content(messages[-1].content))
+
+
+def extract_content(content):
+    """the json documents (one per line) or the code block in content, or
+    otherwise all of it"""
+    documents = extract_json_documents(content)
+    if documents:
+        return "\n".join(documents)
+    elif contains_block(content):
+        return extract_block(content)
     else:
-        print(message.content.strip())
+        return content.strip()
+
+# characters pylatexenc converts, text without them is left as is
+LATEX_MARKERS = re.compile(r"[$&\\{}~]|''|--|[!?`]`")
+
+# converted texts by digest of the message, None if nothing changed
+_latex_texts = {}
+
+
+@functools.lru_cache(maxsize=None)
+def get_latex_converter():
+    from pylatexenc.latex2text import LatexNodes2Text
+
+    return LatexNodes2Text(keep_comments=True)
+
+
+def known_latex_texts(messages):
+    """the memoized conversions of messages as {digest: text}"""
+    digests = {chat.text_digest(message.content) for message in messages}
+    return {
+        digest: _latex_texts[digest] for digest in digests if digest in _latex_texts
+    }
+
+
+def load_latex_texts(texts):
+    """seeds the conversion memo with texts as returned by known_latex_texts"""
+    _latex_texts.update(texts)
+
+
+def forget_latex_texts(messages):
+    """drops the memoized conversions of messages"""
+    for message in messages:
+        _latex_texts.pop(chat.text_digest(message.content), None)
+
 
 def format_latex(msg):
+    if not LATEX_MARKERS.search(msg) and "“" not in msg:
+        return msg
+    digest = chat.text_digest(msg)
+    if digest not in _latex_texts:
+        converted = convert_latex(msg)
+        _latex_texts[digest] = None if converted == msg else converted
+    converted = _latex_texts[digest]
+    return msg if converted is None else converted
+
+
+def convert_latex(msg):
     # Replace code blocks and inline code with markers. Use null delimiters to
     # hopefully avoid any overlap with anything chatgpt could ever output.
     code_block_pattern = re.compile(r"```[\w]*\n.*?\n```", re.DOTALL)
@@ -96,8 +466,8 @@ def format_latex(msg):
     code_inlines = re.findall(code_inline_pattern, msg)
     msg = re.sub(code_inline_pattern, "\0CODE_INLINE\0", msg)
 
-    converter = LatexNodes2Text(keep_comments=True)
-    msg = converter.latex_to_text(msg)
+    if LATEX_MARKERS.search(msg):  # not only in code
+        msg = get_latex_converter().latex_to_text(msg)
 
     # do no change code blocks to smart quotes, this will break the markdown
     # parser.
@@ -119,18 +489,60 @@ def detect_and_format_message(msg, cutoff=None, theme=None):
     if cutoff and len(msg) > cutoff:
         msg = "... **text shortened** ... " + msg[-cutoff:]
         return msg
-    elif contains_json(msg):
-        utils.debug(detected="json")
-        return JSON(extract_json(msg))
-    elif looks_like_markdown(msg):
-        utils.debug(detected="markdown")
+
+    classification = classify(msg)
+    utils.debug(detected=classification.kind, signals=classification.signals)
+    if classification.kind == "json":
+        return JSON(classification.json)
+    elif classification.kind == "markdown":
         theme = "monokai" if theme is None else theme
         return Markdown(msg,code_theme=theme)
     else:
-        utils.debug(detected="regular")
         return msg
 
 
+Classification = collections.namedtuple("Classification", "kind json signals")
+
+# everything classify looks for, in one regex so the message is scanned once.
+# json is a zero width match at the start of a line that may start json, the
+# others are markdown signals. Link texts and urls are bounded and stop at
+# the next [ to keep it linear time, the leading lookahead skips characters no
+# alternative can start at
+CONTENT_SIGNALS = re.compile(
+    r"(?=[`\[_*]|^)(?:"
+    r"(?P<json>^(?=[^\S\n]*[\[{]))"
+    r"|(?P<md_blocks>```.*?```)"
+    r"|(?P<md_inline_blocks>`[^`]+`)"
+    r"|(?P<md_links>\[[^][\n]{1,1000}\]\(https?:\/\/[^\s)[]{1,2000}\))"
+    r"|(?P<md_text>(?<=\s)(?:__|\*\*)(?=\S)))",
+    re.DOTALL | re.MULTILINE,
+)
+
+
+def classify(msg):
+    """classify msg as json, markdown or regular text in a single scan
+    Returns a Classification with the json (as a string) if it is json and
+    the counted markdown signals otherwise"""
+    signals = {"md_links": 0, "md_text": 0, "md_inline_blocks": 0, "md_blocks": 0}
+    json_tried = False
+    for match in CONTENT_SIGNALS.finditer(msg):
+        kind = match.lastgroup
+        if kind != "json":
+            signals[kind] += 1
+        elif not json_tried:
+            # only the first line that may start json counts, and the json
+            # has to be all of the rest of the message
+            json_tried = True
+            try:
+                return Classification("json", parse_json_at(msg, match.start()), None)
+            except ValueError:
+                pass
+
+    score = sum(signals.values()) + signals["md_blocks"]  # blocks count double
+    kind = "markdown" if score >= 2 else "regular"
+    return Classification(kind, None, signals)
+
+
 def extract_json_lists(str_lists, flatten=False):
     lists = [json.loads(extract_json(x)) for x in str_lists if contains_json(x)]
     if flatten:
@@ -155,39 +567,281 @@ def extract_block(str):
 
 def looks_like_markdown(str):
     """very rudimentary, but avoids making things markdown that shouldn't be"""
-    md_links = len(re.findall(r"\[[^]]+\]\(https?:\/\/\S+\)", str))
-    md_text = len(re.findall(r"\s(__|\*\*)(?!\s)(.(?!\1))+(?!\s(?=\1))", str))
-    md_blocks = len(re.findall(r"```(.*?)```", str, re.DOTALL))
-    md_inline_blocks = len(re.findall(r"`[^`]+`", str)) - md_blocks
-
-    md_blocks *= 2
-    utils.debug(
-        title="counted",
-        md_links=md_links,
-        md_text=md_text,
-        md_inline_blocks=md_inline_blocks,
-        md_blocks=md_blocks,
-    )
-    score = md_links + md_text + md_inline_blocks + md_blocks
-    return score >= 2
+    return classify(str).kind == "markdown"
 
 
 def contains_json(str):
-    try:
-        extract_json(str)
-    except ValueError:
-        return False
-    return True
+    return next(find_json(str), None) is not None
 
 
 def extract_json(str):
     """
     try to extract json from a string that may contain other lines before the json
-    returns the json as a string or raises a ValueError if no json is found
+    returns the first json document as a string or raises a ValueError if no json
+    is found
     """
-    lines_with_idxs = enumerate(str.splitlines())
-    for idx, line in lines_with_idxs:
-        if line.strip().startswith("{") or line.strip().startswith("["):
-            return json.dumps(json.loads(" ".join(str.splitlines()[idx:])))
+    for _, _, value in find_json(str):
+        return json.dumps(value)
 
     raise ValueError("No json in string")
+
+
+def extract_json_documents(str):
+    """all json documents in str, as strings"""
+    return [json.dumps(value) for _, _, value in find_json(str)]
+
+
+# a line starting a json object or array, the first thing in it has to be
+# able to start a json value, so lines that can't be json aren't decoded
+JSON_LINE = re.compile(
+    r'^[^\S\n]*(?:\{(?=\s*["}])|\[(?=\s*[]"{[\-0-9tfn]))', re.MULTILINE
+)
+FENCE_LINE = re.compile(r"^[^\S\n]*```", re.MULTILINE)
+LINE_END = re.compile(r"[^\S\n]*(?:\n|\Z)")
+
+# answers often break long strings over several lines, so control characters
+# are allowed in strings
+JSON_DECODER = json.JSONDecoder(strict=False)
+
+
+# the text a value is first decoded in, grown while the value may continue
+DECODE_WINDOW = 1024
+
+
+def decode_json(str, start):
+    """decode the json value at offset start, returns (value, end)
+    It is decoded in a window of str, so a failure costs the text that was
+    read rather than the offset, which the error counts the lines up to"""
+    size = DECODE_WINDOW
+    while True:
+        window = str[start : start + size]
+        truncated = start + size < len(str)
+        try:
+            value, end = JSON_DECODER.raw_decode(window)
+        except json.JSONDecodeError as e:
+            # where it fails might be within the value after the window, a
+            # string reports where it starts
+            if truncated and (
+                e.pos >= len(window) - 16 or e.msg.startswith("Unterminated")
+            ):
+                size *= 4
+                continue
+            e.pos += start
+            raise
+        except RecursionError:  # nested too deep to be an answer worth printing
+            end = too_deep_at(str, start)
+            window = str[start:end]
+            error = json.JSONDecodeError("json nested too deeply", window, len(window))
+            error.pos += start
+            raise error
+        if truncated and end >= len(window) - 16:  # a number may go on
+            size *= 4
+            continue
+        return value, start + end
+
+
+# nesting deeper than this fails where it gets deeper, when it is too deep
+# to decode
+MAX_JSON_DEPTH = 256
+
+JSON_TOKENS = re.compile(r'["\\\[\]{}]')
+
+
+def too_deep_at(str, start):
+    """the offset of the bracket nesting the value at start deeper than
+    MAX_JSON_DEPTH, or where it ends"""
+    depth = 0
+    in_string = False
+    i = start
+    while True:
+        match = JSON_TOKENS.search(str, i)
+        if not match:
+            return len(str)
+        token = match.group()
+        i = match.end()
+        if in_string:
+            if token == '"':
+                in_string = False
+            elif token == "\\":
+                i += 1
+        elif token == '"':
+            in_string = True
+        elif token in "[{":
+            depth += 1
+            if depth > MAX_JSON_DEPTH:
+                return match.start()
+        elif token in "]}":
+            depth -= 1
+            if depth == 0:
+                return i
+
+
+def find_json(str, pos=0):
+    """
+    yields (start, end, value) for the json documents in str that start a line
+    and end it. Text between the documents is skipped, as are code blocks, and
+    a line that only looks like the start of json is skipped up to where it
+    stops being json
+    """
+    in_fence = False
+    scanned = pos  # fences are counted up to here
+    while True:
+        match = JSON_LINE.search(str, pos)
+        if not match:
+            return
+        start = match.end() - 1
+        in_fence ^= len(FENCE_LINE.findall(str, scanned, start)) % 2 == 1
+        scanned = start
+        if in_fence:
+            pos = start + 1
+            continue
+        try:
+            value, end = decode_json(str, start)
+        except json.JSONDecodeError as e:
+            pos = scanned = max(e.pos, start + 1)
+            continue
+        if not LINE_END.match(str, end):  # text follows it on the line
+            pos = start + 1
+            continue
+        yield start, end, value
+        pos = scanned = end
+
+
+def parse_json_at(str, start):
+    """parse the json that starts the line at offset start and spans the rest
+    of str"""
+    match = JSON_LINE.match(str, start)
+    if not match:
+        raise ValueError("No json")
+    value, end = decode_json(str, match.end() - 1)
+    if str[end:].strip():
+        raise ValueError("Text after json")
+    return json.dumps(value)
+
+
+class JsonExtractor:
+    """finds the json documents in a streamed text as soon as they are complete,
+    the same documents find_json finds in the whole text
+
+    Only the text of the document being read is kept, it is decoded once its
+    brackets are balanced and yielded once the rest of its line is blank"""
+
+    BLANK = re.compile(r"[^\S\n]*")
+    TOKENS = JSON_TOKENS
+
+    def __init__(self):
+        self.state = "line_start"  # or "in_line", "in_json", "after_json"
+        self.in_fence = False
+        self.pending = ""  # the start of a line that may be a fence
+        self.chunks = []
+        self.depth = 0
+        self.in_string = False
+        self.skip = 0  # characters still to skip after an escape
+        self.document = None  # and its value, until the end of its line
+        self.value = None
+
+    def feed(self, text):
+        """returns the values of the documents completed by text"""
+        text = self.pending + text
+        self.pending = ""
+        values = []
+        i = 0
+        while i < len(text):
+            if self.state == "in_line":
+                newline = text.find("\n", i)
+                if newline < 0:
+                    break
+                i = newline + 1
+                self.state = "line_start"
+            elif self.state == "line_start":
+                i = self.BLANK.match(text, i).end()
+                if i == len(text):
+                    break
+                if text.startswith("```", i):
+                    self.in_fence = not self.in_fence
+                    self.state = "in_line"
+                elif "```".startswith(text[i:]):
+                    self.pending = text[i:]
+                    break
+                elif text[i] == "\n":
+                    i += 1
+                elif text[i] in "[{" and not self.in_fence:
+                    self.state = "in_json"
+                    self.chunks = []
+                    self.depth = 0
+                    self.in_string = False
+                    self.skip = 0
+                else:
+                    self.state = "in_line"
+            elif self.state == "in_json":
+                end = self.scan(text, i)
+                if end is None:
+                    self.chunks.append(text[i:])
+                    break
+                self.chunks.append(text[i:end])
+                document = "".join(self.chunks)
+                self.chunks = []
+                self.state = "in_line"
+                try:
+                    self.value = decode_json(document, 0)[0]
+                    self.document = document
+                    self.state = "after_json"
+                    i = end
+                except json.JSONDecodeError as e:
+                    # resume after where it stopped being json, like find_json
+                    text = document[max(e.pos, 1) :] + text[end:]
+                    i = 0
+                    if document[max(e.pos, 1) - 1] == "\n":
+                        self.state = "line_start"
+            else:
+                blank = self.BLANK.match(text, i).end()
+                self.document += text[i:blank]
+                if blank == len(text):
+                    break
+                if text[blank] == "\n":
+                    values.append(self.value)
+                    i = blank + 1
+                    self.state = "line_start"
+                else:  # text follows it on the line, it isn't a document
+                    text = self.document[1:] + text[blank:]
+                    i = 0
+                    self.state = "in_line"
+                self.document = self.value = None
+        return values
+
+    def scan(self, text, i):
+        """the offset in text after the bracket that closes the document, or
+        None if it isn't closed in text"""
+        i += self.skip
+        self.skip = 0
+        while True:
+            if i > len(text):
+                self.skip = i - len(text)
+                return None
+            match = self.TOKENS.search(text, i)
+            if not match:
+                return None
+            token = match.group()
+            i = match.end()
+            if self.in_string:
+                if token == '"':
+                    self.in_string = False
+                elif token == "\\":
+                    i += 1
+            elif token == '"':
+                self.in_string = True
+            elif token in "[{":
+                self.depth += 1
+            elif token in "]}":
+                self.depth -= 1
+                if self.depth == 0:
+                    return i
+
+    def close(self):
+        """returns the values of the documents in the rest of the text"""
+        if self.state == "after_json":
+            values = [self.value]
+        else:
+            values = [value for _, _, value in find_json("".join(self.chunks))]
+        self.__init__()
+        return values
@@ -0,0 +1,174 @@
+"""
+Client side rate limiting and retries of API requests
+
+Requests are admitted against a requests per minute and a tokens per minute
+token bucket (the tokens estimated with tiktoken). The buckets are kept in
+the cache path and shared by all chatblade processes through a lock file.
+Rate limited (429), server (5xx) and connection errors are retried with
+jittered exponential backoff, honoring Retry-After
+"""
+
+import asyncio
+import contextlib
+import email.utils
+import json
+import os
+import random
+import threading
+import time
+
+from . import chat, storage
+
+try:
+    import fcntl
+except ImportError:  # windows, buckets are only shared within the process
+    fcntl = None
+
+DEFAULT_RETRIES = 3
+
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+
+_thread_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def locked_state():
+    """the bucket state, locked for all processes while in use"""
+    cache_path = storage.get_cache_path()
+    with _thread_lock, open(os.path.join(cache_path, "ratelimit.lock"), "w") as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        state_path = os.path.join(cache_path, "ratelimit.json")
+        try:
+            with open(state_path, "r") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        yield state
+        with open(state_path, "w") as f:
+            json.dump(state, f)
+
+
+class Scheduler:
+    """admits and retries the requests of one query"""
+
+    def __init__(self, messages, config):
+        self.rpm = config.get("rpm")
+        self.tpm = config.get("tpm")
+        self.retries = config.get("retries")
+        if self.retries is None:
+            self.retries = DEFAULT_RETRIES
+        self.key = f"{config.get('openai_base_url') or ''} {config.get('model')}"
+        self.tokens = 0
+        if self.tpm:
+            cost_config = chat.CostConfig(config.get("model"), 0, 0)
+            self.tokens = chat.num_tokens_in_messages(messages, cost_config)[0]
+
+    def admission_delay(self):
+        """take a request (and its tokens) from the buckets and return 0,
+        or return how long to wait until the buckets allow it"""
+        if not (self.rpm or self.tpm):
+            return 0
+        with locked_state() as state:
+            now = time.time()
+            buckets = state.setdefault(self.key, {})
+            delays = []
+            for name, per_minute, needed in [
+                ("requests", self.rpm, 1),
+                ("tokens", self.tpm, self.tokens),
+            ]:
+                if not per_minute:
+                    continue
+                # a request larger than the bucket waits for a full bucket
+                needed = min(needed, per_minute)
+                level, updated = buckets.get(name, (per_minute, now))
+                level = min(per_minute, level + (now - updated) * per_minute / 60)
+                buckets[name] = (level, now)
+                if level < needed:
+                    delays.append((needed - level) * 60 / per_minute)
+            if delays:
+                return max(delays)
+            for name, needed in [("requests", 1), ("tokens", self.tokens)]:
+                if name in buckets:
+                    level, _ = buckets[name]
+                    buckets[name] = (level - needed, now)
+            return 0
+
+    def retry_delay(self, error, attempt):
+        """how long to wait before retrying after error, None to give up"""
+        import openai
+
+        if attempt >= self.retries:
+            return None
+        if isinstance(error, openai.APIStatusError):
+            if error.status_code != 429 and error.status_code < 500:
+                return None
+            retry_after = parse_retry_after(error.response.headers)
+            if retry_after is not None:
+                return retry_after + random.uniform(0, BACKOFF_BASE)
+        elif not isinstance(error, openai.APIConnectionError):
+            return None
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+
+
+def parse_retry_after(headers):
+    """seconds to wait according to the retry-after(-ms) headers, or None"""
+    try:
+        return float(headers["retry-after-ms"]) / 1000
+    except (KeyError, ValueError):
+        pass
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after).timestamp()
+    except (TypeError, ValueError):
+        return None
+    return max(retry_at - time.time(), 0)
+
+
+def call(request, messages, config):
+    """call request() once admitted, retrying it when it fails transiently"""
+    import openai
+
+    scheduler = Scheduler(messages, config)
+    attempt = 0
+    while True:
+        delay = scheduler.admission_delay()
+        while delay:
+            time.sleep(delay)
+            delay = scheduler.admission_delay()
+        try:
+            return request()
+        except openai.OpenAIError as e:
+            delay = scheduler.retry_delay(e, attempt)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            attempt += 1
+
+
+async def call_async(request, messages, config):
+    """call, for a request returning an awaitable"""
+    import openai
+
+    scheduler = Scheduler(messages, config)
+    attempt = 0
+    while True:
+        delay = scheduler.admission_delay()
+        while delay:
+            await asyncio.sleep(delay)
+            delay = scheduler.admission_delay()
+        try:
+            return await request()
+        except openai.OpenAIError as e:
+            delay = scheduler.retry_delay(e, attempt)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+            attempt += 1
@@ -0,0 +1,114 @@
+"""
+Local cache of responses, so identical queries (same model, messages and
+settings) are answered without going over the wire.
+Entries live in the responses directory of the cache path, are dropped
+once they are older than the ttl, and the least recently used ones are
+evicted when the cache grows beyond MAX_CACHE_BYTES
+"""
+
+import hashlib
+import json
+import os
+import time
+
+from . import chat, storage, utils
+
+MAX_CACHE_BYTES = 64 * 1024 * 1024
+
+DEFAULT_TTL_HOURS = 24 * 7
+
+
+def get_responses_path():
+    responses_path = os.path.join(storage.get_cache_path(), "responses")
+    if not os.path.exists(responses_path):
+        os.makedirs(responses_path, exist_ok=True)
+    return responses_path
+
+
+def cache_key(messages, config):
+    """hash of everything that determines the response"""
+    settings = utils.merge_dicts(chat.DEFAULT_OPENAI_SETTINGS, config)
+    del settings["stream"]  # streamed or not, the response is the same
+    keyed = {
+        "messages": [msg.api_dict() for msg in messages],
+        "settings": settings,
+        "base_url": config.get("openai_base_url"),
+        "azure_deployment": os.environ.get("OPENAI_API_AZURE_ENGINE"),
+    }
+    encoded = json.dumps(keyed, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def load(key, ttl):
+    """the cached Message for key, or None if not cached or expired"""
+    file_path = os.path.join(get_responses_path(), f"{key}.json")
+    try:
+        with open(file_path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - entry["created"] > ttl:
+        try:
+            os.unlink(file_path)
+        except FileNotFoundError:
+            pass  # removed concurrently
+        return None
+    try:
+        os.utime(file_path)  # the mtime tracks the last use for eviction
+    except FileNotFoundError:
+        pass  # evicted concurrently, after it was read
+    return chat.Message(entry["role"], entry["content"])
+
+
+def store(key, message):
+    responses_path = get_responses_path()
+    file_path = os.path.join(responses_path, f"{key}.json")
+    file_path_tmp = file_path + storage.make_postfix()
+    # without the usage, a replayed answer costs nothing
+    entry = {"created": time.time(), **message.api_dict()}
+    with open(file_path_tmp, "w", encoding="utf-8") as f:
+        json.dump(entry, f, ensure_ascii=False)
+    os.replace(file_path_tmp, file_path)
+    evict(responses_path)
+
+
+def evict(responses_path, max_bytes=MAX_CACHE_BYTES):
+    """remove the least recently used entries until the cache fits max_bytes"""
+    entries = []
+    total = 0
+    with os.scandir(responses_path) as it:
+        for entry in it:
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+    entries.sort()
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass  # evicted concurrently
+        total -= size
+
+
+def query_chat_gpt(messages, config):
+    """chat.query_chat_gpt answered from the cache when possible. Cached
+    responses are replayed as a stream when a stream is requested"""
+    key = cache_key(messages, config)
+    ttl = (config.get("cache_ttl") or DEFAULT_TTL_HOURS) * 3600
+    message = load(key, ttl)
+    if message:
+        utils.debug(title="response cache", hit=key)
+        if config.get("stream"):
+            return chat.ReplayedMessageStream(message)
+        return message
+
+    result = chat.query_chat_gpt(messages, config)
+    if isinstance(result, chat.MessageStream):
+        # only cache streams that complete
+        result.on_complete.append(lambda message: store(key, message))
+    else:
+        store(key, result)
+    return result
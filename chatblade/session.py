@@ -6,19 +6,24 @@ from . import storage
 
 
 def list_sessions():
-    """List names of sessions"""
-    sess_paths = glob.glob(os.path.join(storage.get_cache_path(), "*.yaml"))
+    """List names of sessions, including not yet migrated yaml sessions"""
+    cache_path = storage.get_cache_path()
+    sess_paths = glob.glob(os.path.join(cache_path, "*.jsonl")) + glob.glob(
+        os.path.join(cache_path, "*.yaml")
+    )
     return sorted(
-        [
-            re.sub("\\.yaml\\Z", "", os.path.basename(sess_path))
+        {
+            re.sub("\\.(jsonl|yaml)\\Z", "", os.path.basename(sess_path))
             for sess_path in sess_paths
-        ]
+        }
     )
 
 
 def rename_session(session, newname):
     """renames session
     Returns None on success, error string otherwise"""
+    from . import index
+
     session_path = storage.get_session_path(session, True)
     if not session_path:
         return f"session {session} does not exist"
@@ -27,12 +32,24 @@ def rename_session(session, newname):
         return f"session {newname} already exists"
     new_session_path = storage.get_session_path(newname)
     os.rename(session_path, new_session_path)
+    storage.update_index(index.rename_session, session, newname)
+    for sidecar in storage.SIDECARS:
+        sidecar_path = storage.get_sidecar_path(session, sidecar, True)
+        if sidecar_path:
+            os.replace(sidecar_path, storage.get_sidecar_path(newname, sidecar))
 
 
 def delete_session(session):
     """deletes a session
     Returns None on success, error string otherwise"""
+    from . import index
+
     session_path = storage.get_session_path(session, True)
     if not session_path:
         return f"session {session} does not exist"
     os.unlink(session_path)
+    storage.update_index(index.delete_session, session)
+    for sidecar in storage.SIDECARS:
+        sidecar_path = storage.get_sidecar_path(session, sidecar, True)
+        if sidecar_path:
+            os.unlink(sidecar_path)
@@ -3,18 +3,23 @@ Handles storage of cache and prompt config directories, as well
 as figuring out where to put them on various platforms 
 """
 
+import json
 import os
-import platformdirs
-import pickle
-import yaml
 import random
 import string
 
-from . import errors, chat
+from . import errors, chat, timing, utils
 
 APP_NAME = "chatblade"
 
 
+def yaml_safe_loader():
+    """prefer the libyaml based loader, it is an order of magnitude faster"""
+    import yaml
+
+    return getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
 def make_postfix():
     return "." + "".join(random.choices(string.ascii_letters + string.digits, k=10))
 
@@ -27,6 +32,8 @@ def get_cache_path(create=True):
     """
     os_cache_path = os.path.expanduser("~/.cache")
     if not os.path.exists(os_cache_path):
+        import platformdirs
+
         os_cache_path = platformdirs.user_cache_dir(APP_NAME)
         if not os.path.exists(os_cache_path):
             os.makedirs(os_cache_path)
@@ -41,30 +48,308 @@ def get_cache_path(create=True):
 def get_session_path(session, exists=False):
     """get the path of a session file
     If exists=True, return None if the path does not exists"""
-    session_path = os.path.join(get_cache_path(), f"{session}.yaml")
-    if exists and not os.path.exists(session_path):
-        return
+    session_path = os.path.join(get_cache_path(), f"{session}.jsonl")
+    if not os.path.exists(session_path):
+        migrate_yaml_session(session)
+        if exists and not os.path.exists(session_path):
+            return
     return session_path
 
 
-def to_cache(messages, session):
-    """cache the current messages state"""
-    file_path = get_session_path(session)
+def get_yaml_session_path(session):
+    """LEGACY: path of a session stored as a single yaml document"""
+    return os.path.join(get_cache_path(), f"{session}.yaml")
+
+
+def migrate_yaml_session(session):
+    """convert a yaml session to the append only jsonl format, if one exists"""
+    yaml_path = get_yaml_session_path(session)
+    if not os.path.exists(yaml_path):
+        return
+    import yaml
+
+    loader = yaml_safe_loader()
+    with open(yaml_path, "r") as f:
+        messages = [chat.Message.import_yaml(m) for m in yaml.load(f, loader) or []]
+    write_session(messages, os.path.join(get_cache_path(), f"{session}.jsonl"))
+    os.unlink(yaml_path)
+
+
+# files kept next to a session as <session>.<sidecar>.json, they are renamed
+# and deleted together with the session
+SIDECARS = ["tokens", "summary", "latex", "legacy tokens"]
+
+# sidecars in other files: the token counts are appended to as json lines,
+# they were a single json object before
+SIDECAR_FILES = {"tokens": "tokens.jsonl", "legacy tokens": "tokens.json"}
+
+
+def get_sidecar_path(session, sidecar, exists=False):
+    """get the path of a sidecar file of a session
+    If exists=True, return None if the path does not exists"""
+    file_name = SIDECAR_FILES.get(sidecar, f"{sidecar}.json")
+    sidecar_path = os.path.join(get_cache_path(), f"{session}.{file_name}")
+    if exists and not os.path.exists(sidecar_path):
+        return
+    return sidecar_path
+
+
+def sidecar_to_cache(obj, session, sidecar):
+    file_path = get_sidecar_path(session, sidecar)
+    file_path_tmp = file_path + make_postfix()
+    with open(file_path_tmp, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False)
+    os.replace(file_path_tmp, file_path)
+
+
+def sidecar_from_cache(session, sidecar):
+    """load a sidecar, None if it does not exist or can't be read"""
+    file_path = get_sidecar_path(session, sidecar, True)
+    if not file_path:
+        return None
+    try:
+        with open(file_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+# last message persisted per session by this process, together with the
+# number of messages in the session file at that point
+_persisted = {}
+
+# set in a daemon worker to a function taking the session, the model and the
+# number of messages that were in the file already. The file is then written
+# without syncing it, the daemon syncs it and updates the index and token
+# counts after the answer was printed
+write_behind = None
+
+# the sessions a daemon keeps in memory, by path: the (size, mtime_ns) of the
+# file they were read from and their messages, least recently used first
+_hot = None
+# the most sessions kept in _hot
+HOT_SESSIONS = 8
+
+
+def to_cache(messages, session, model=None):
+    """cache the current messages state
+    Only the messages added since the session was last loaded or cached are
+    appended to the session file, anything else rewrites it as a whole.
+    model is the model the session was last used with, for the index"""
+    from . import index
+
+    with timing.span("persist"):
+        file_path = get_session_path(session)
+        count, last = _persisted.get(session, (0, None))
+        sync = write_behind is None
+        if (
+            0 < count <= len(messages)
+            and messages[count - 1] == last
+            and os.path.exists(file_path)
+        ):
+            append_session(messages[count:], file_path, sync)
+        else:
+            write_session(messages, file_path, sync)
+            count = 0
+        _persisted[session] = (len(messages), messages[-1] if messages else None)
+        if write_behind:
+            write_behind(session, model, count)
+            return
+        with timing.span("index"):
+            update_index(index.update_session, session, messages, count, model)
+        token_counts_to_cache(messages, session, count)
+
+
+def update_index(update, *args):
+    """call an update of the session index, which doesn't fail the operation
+    on the session when it fails, the session is indexed again when listed"""
+    try:
+        update(*args)
+    except Exception as e:
+        utils.debug(title="session index", error=repr(e))
+
+
+def message_lines(messages):
+    return "".join(
+        json.dumps(msg.export_json(), ensure_ascii=False) + "\n" for msg in messages
+    )
+
+
+def write_session(messages, file_path, sync=True):
+    """atomically replace the session file with messages"""
     file_path_tmp = file_path + make_postfix()
-    with open(file_path_tmp, "w") as f:
-        yaml.dump(messages, f)
+    with open(file_path_tmp, "w", encoding="utf-8") as f:
+        f.write(message_lines(messages))
+        f.flush()
+        if sync:
+            os.fsync(f.fileno())
     os.replace(file_path_tmp, file_path)
 
 
+def append_session(messages, file_path, sync=True):
+    """append messages to the session file
+    A partial line left behind by an interrupted append is dropped first"""
+    if not messages:
+        return
+    with open(file_path, "r+b") as f:
+        end = f.seek(0, os.SEEK_END)
+        if end:
+            f.seek(end - 1)
+            if f.read(1) != b"\n":
+                f.seek(0)
+                f.truncate(f.read().rfind(b"\n") + 1)
+        f.seek(0, os.SEEK_END)
+        f.write(message_lines(messages).encode("utf-8"))
+        f.flush()
+        if sync:
+            os.fsync(f.fileno())
+
+
+def token_counts_to_cache(messages, session, persisted=0):
+    """cache the known per message token counts of a session, so they
+    only need to be computed for messages added after this write
+    When persisted of the messages were cached before, only the counts of
+    the ones added after them are appended, if any were counted"""
+    if not get_session_path(session, True):
+        return
+    counts = chat.known_token_counts(messages[persisted:])
+    file_path = get_sidecar_path(session, "tokens")
+    if persisted:
+        if counts:
+            append_token_counts(counts, session)
+    elif counts:
+        file_path_tmp = file_path + make_postfix()
+        with open(file_path_tmp, "w", encoding="utf-8") as f:
+            f.write(json.dumps(counts) + "\n")
+        os.replace(file_path_tmp, file_path)
+    elif os.path.exists(file_path):
+        os.unlink(file_path)
+
+
+def append_token_counts(counts, session):
+    with open(get_sidecar_path(session, "tokens"), "a", encoding="utf-8") as f:
+        f.write(json.dumps(counts) + "\n")
+
+
+def token_counts_from_cache(session):
+    """load the cached token counts of a session into the token count memo
+    the counts are only a cache, missing ones will be recomputed"""
+    legacy_path = get_sidecar_path(session, "legacy tokens", True)
+    if legacy_path:
+        counts = sidecar_from_cache(session, "legacy tokens")
+        if counts:
+            append_token_counts(counts, session)
+        os.unlink(legacy_path)
+    file_path = get_sidecar_path(session, "tokens", True)
+    if not file_path:
+        return
+    try:
+        with open(file_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    chat.load_token_counts(json.loads(line))
+                except ValueError:  # an interrupted append, and what follows it
+                    pass
+    except OSError:
+        pass
+
+
 def messages_from_cache(session):
     """load messages from session
     Return empty list if not exists"""
-    file_path = get_session_path(session)
-    if not os.path.exists(file_path):
+    file_path = get_session_path(session, True)
+    if not file_path:
         return []
+    messages = None
+    if _hot is not None:
+        stat = os.stat(file_path)
+        version = (stat.st_size, stat.st_mtime_ns)
+        if file_path in _hot and _hot[file_path][0] == version:
+            messages = list(_hot[file_path][1])
+    if messages is None:
+        messages = []
+        with open(file_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break  # an interrupted append, never acknowledged
+                messages.append(chat.Message.import_json(json.loads(line)))
+    if _hot is not None:
+        keep_hot(file_path, version, messages)
+    # after keep_hot, which may forget counts this session shares
+    token_counts_from_cache(session)
+    _persisted[session] = (len(messages), messages[-1] if messages else None)
+    return messages
+
+
+def keep_hot(file_path, version, messages):
+    """keep the messages of a session in _hot, evicting the least recently
+    used sessions beyond HOT_SESSIONS along with their memoized token counts
+    and latex conversions"""
+    from . import printer
+
+    if file_path in _hot and _hot[file_path][0] == version:
+        _hot.move_to_end(file_path)
     else:
-        with open(file_path, "r") as f:
-            return [chat.Message.import_yaml(m) for m in yaml.load(f, yaml.SafeLoader)]
+        _hot[file_path] = (version, tuple(messages))
+    while len(_hot) > HOT_SESSIONS:
+        _, (_, evicted) = _hot.popitem(last=False)
+        chat.forget_token_counts(evicted)
+        printer.forget_latex_texts(evicted)
+
+
+def last_message_from_cache(session):
+    """load only the last message of a session by reading the session file
+    backwards. Return None if not exists or empty"""
+    messages = tail_messages_from_cache(session, 1)
+    return messages[-1] if messages else None
+
+
+def tail_messages_from_cache(session, n):
+    """load the last n messages of a session, reading the session file
+    backwards. Return empty list if not exists"""
+    file_path = get_session_path(session, True)
+    if not file_path:
+        return []
+    with open(file_path, "rb") as f:
+        lines = tail_lines(f, n)
+    return [chat.Message.import_json(json.loads(line)) for line in lines]
+
+
+def iter_messages_from_cache(session, start=0, stop=None):
+    """yield the messages of a session from position start up to stop as
+    they are read, the ones before start aren't decoded"""
+    file_path = get_session_path(session, True)
+    if not file_path:
+        return
+    with open(file_path, "r", encoding="utf-8") as f:
+        for position, line in enumerate(f):
+            if stop is not None and position >= stop:
+                break
+            if not line.endswith("\n"):
+                break  # an interrupted append, never acknowledged
+            if position >= start:
+                yield chat.Message.import_json(json.loads(line))
+
+
+def tail_lines(f, n, block_size=64 * 1024):
+    """read the last n complete lines of a binary file object, without
+    reading any more of the file than needed"""
+    pos = f.seek(0, os.SEEK_END)
+    blocks = []
+    newlines = 0
+    while pos > 0 and newlines <= n:
+        step = min(block_size, pos)
+        pos -= step
+        f.seek(pos)
+        block = f.read(step)
+        blocks.append(block)
+        newlines += block.count(b"\n")
+    lines = b"".join(reversed(blocks)).split(b"\n")
+    # after the last newline is either nothing or an interrupted append
+    lines.pop()
+    if pos > 0:
+        lines.pop(0)  # possibly started halfway through a line
+    return lines[-n:] if n else []
 
 
 def messages_from_cache_legacy():
@@ -73,6 +358,8 @@ def messages_from_cache_legacy():
     if not os.path.exists(file_path):
         raise errors.ChatbladeError("No last state cached from which to begin")
     else:
+        import pickle
+
         with open(file_path, "rb") as f:
             return pickle.load(f)
 
@@ -119,6 +406,8 @@ def load_prompt_config_legacy_yaml(prompt_name):
     load a prompt configuration by its name
     Assumes the user created the {name}.yaml in ~/.config/chatblade
     """
+    import yaml
+
     path = os.path.expanduser(
         os.path.join("~/.config/chatblade", f"{prompt_name}.yaml")
     )
@@ -0,0 +1,336 @@
+"""
+A local stand-in for the OpenAI API, to run chatblade against without
+hitting the real one: python -m chatblade.stubserver, then chatblade
+--openai-base-url http://127.0.0.1:8000/v1 (any api key will do)
+
+It answers /v1/chat/completions, streamed or not, with generated text or
+replayed transcripts, after a configurable time to first token and delay
+between tokens, and fails a configurable share of the requests with a server
+error or a 429 with Retry-After, so the latency, retry and rendering paths
+can be measured deterministically (failures and texts follow --seed).
+With --record it forwards the requests to --upstream instead and records
+the answers as transcripts, to --replay later
+"""
+
+import argparse
+import hashlib
+import http.server
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.request
+import uuid
+
+WORDS = (
+    "the a of stream token render session model answer query **bold** `code`"
+    " latency chunk message"
+).split()
+
+
+def transcript_key(messages):
+    """what a request is replayed by, its messages"""
+    encoded = json.dumps(
+        [[m.get("role"), m.get("content")] for m in messages], ensure_ascii=False
+    )
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def load_transcripts(path):
+    """the answers of a transcript file (one json object per line) by key"""
+    transcripts = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                transcript = json.loads(line)
+                transcripts[transcript_key(transcript["messages"])] = transcript
+    return transcripts
+
+
+def generate_text(messages, tokens, seed):
+    """words of text, the same for the same messages and seed"""
+    rnd = random.Random(f"{seed} {transcript_key(messages)}")
+    return " ".join(rnd.choice(WORDS) for _ in range(tokens))
+
+
+def split_tokens(text):
+    """text in pieces of about a token, words with their leading space"""
+    pieces = []
+    start = 0
+    for i in range(1, len(text)):
+        if text[i] == " " and text[i - 1] != " ":
+            pieces.append(text[start:i])
+            start = i
+    if text:
+        pieces.append(text[start:])
+    return pieces
+
+
+def count_tokens(text):
+    """an estimate, the server doesn't tokenize"""
+    return (len(text) + 3) // 4
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, options):
+        super().__init__(address, Handler)
+        self.options = options
+        self.rnd = random.Random(options.seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.transcripts = load_transcripts(options.replay) if options.replay else {}
+
+    def draw_failure(self):
+        """None, or the status code the next request fails with"""
+        with self.lock:
+            self.requests += 1
+            draw = self.rnd.random()
+        if draw < self.options.error_rate:
+            return 500
+        if draw < self.options.error_rate + self.options.rate_limit_rate:
+            return 429
+        return None
+
+    def answer(self, request):
+        """the answer to request: content, role and the usage"""
+        messages = request.get("messages") or []
+        if self.options.record:
+            answer = self.forward(request)
+        elif transcript_key(messages) in self.transcripts:
+            answer = self.transcripts[transcript_key(messages)]
+        else:
+            content = generate_text(messages, self.options.tokens, self.options.seed)
+            answer = {"role": "assistant", "content": content}
+        prompt = "".join(str(m.get("content") or "") for m in messages)
+        usage = answer.get("usage") or {
+            "prompt_tokens": count_tokens(prompt),
+            "completion_tokens": len(split_tokens(answer["content"])),
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        return answer["content"], answer.get("role") or "assistant", usage
+
+    def forward(self, request):
+        """ask upstream, unstreamed, and record its answer"""
+        body = json.dumps({**request, "stream": False}).encode("utf-8")
+        upstream = urllib.request.Request(
+            self.options.upstream.rstrip("/") + "/chat/completions",
+            data=body,
+            headers={
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer {os.environ.get('OPENAI_API_KEY', '')}",
+            },
+        )
+        with urllib.request.urlopen(upstream) as response:
+            result = json.load(response)
+        message = result["choices"][0]["message"]
+        transcript = {
+            "messages": request.get("messages") or [],
+            "role": message["role"],
+            "content": message["content"],
+            "usage": result.get("usage"),
+        }
+        with self.lock, open(self.options.record, "a", encoding="utf-8") as f:
+            f.write(json.dumps(transcript, ensure_ascii=False) + "\n")
+        return transcript
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    # keeps connections open between requests, like the real API
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.options.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status, obj, headers=()):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, message, error_type, headers=()):
+        error = {"message": message, "type": error_type, "code": None}
+        self.send_json(status, {"error": error}, headers)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            model = {"id": "stub", "object": "model", "owned_by": "chatblade"}
+            self.send_json(200, {"object": "list", "data": [model]})
+        else:
+            self.send_error_json(404, f"unknown path {self.path}", "invalid_request")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_error_json(404, f"unknown path {self.path}", "invalid_request")
+            return
+        try:
+            request = json.loads(body)
+        except ValueError:
+            self.send_error_json(400, "the body is not json", "invalid_request")
+            return
+        options = self.server.options
+        if options.reject_stream_options and "stream_options" in request:
+            message = "Unrecognized request argument supplied: stream_options"
+            self.send_error_json(400, message, "invalid_request_error")
+            return
+        failure = self.server.draw_failure()
+        if failure == 429:
+            retry_after = [("Retry-After", str(options.retry_after))]
+            self.send_error_json(429, "rate limited", "rate_limit", retry_after)
+            return
+        if failure:
+            self.send_error_json(500, "injected server error", "server_error")
+            return
+        try:
+            content, role, usage = self.server.answer(request)
+        except Exception as e:
+            self.send_error_json(502, f"upstream failed: {e}", "server_error")
+            return
+
+        completion = {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "created": int(time.time()),
+            "model": request.get("model") or "stub",
+        }
+        time.sleep(options.ttft)
+        if request.get("stream"):
+            self.stream(completion, content, role, usage, request)
+            return
+        time.sleep(options.token_delay * max(len(split_tokens(content)) - 1, 0))
+        choice = {
+            "index": 0,
+            "message": {"role": role, "content": content},
+            "finish_reason": "stop",
+        }
+        self.send_json(
+            200,
+            {
+                **completion,
+                "object": "chat.completion",
+                "choices": [choice],
+                "usage": usage,
+            },
+        )
+
+    def stream(self, completion, content, role, usage, request):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        chunk = {**completion, "object": "chat.completion.chunk"}
+
+        def send_delta(delta, finish_reason=None):
+            choice = {"index": 0, "delta": delta, "finish_reason": finish_reason}
+            self.send_event({**chunk, "choices": [choice]})
+
+        send_delta({"role": role, "content": ""})
+        for i, token in enumerate(split_tokens(content)):
+            if i:
+                time.sleep(self.server.options.token_delay)
+            send_delta({"content": token})
+        send_delta({}, "stop")
+        if (request.get("stream_options") or {}).get("include_usage"):
+            self.send_event({**chunk, "choices": [], "usage": usage})
+        self.send_event("[DONE]")
+        self.send_chunk(b"")
+
+    def send_event(self, data):
+        if not isinstance(data, str):
+            data = json.dumps(data)
+        self.send_chunk(f"data: {data}\n\n".encode("utf-8"))
+
+    def send_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+
+def make_server(options, host="127.0.0.1", port=0):
+    """a StubServer, not serving yet. With port 0 it picks a free one, see
+    server.server_port. options are parsed by build_parser"""
+    return StubServer((host, port), options)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m chatblade.stubserver",
+        description="a local stand-in for the OpenAI chat completions API",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--ttft", type=float, default=0.2, help="seconds to the first token"
+    )
+    parser.add_argument(
+        "--token-delay", type=float, default=0.02, help="seconds between tokens"
+    )
+    parser.add_argument(
+        "--tokens", type=int, default=200, help="tokens in a generated answer"
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0,
+        help="share of the requests failing with a 500",
+    )
+    parser.add_argument(
+        "--rate-limit-rate",
+        type=float,
+        default=0,
+        help="share of the requests failing with a 429",
+    )
+    parser.add_argument(
+        "--retry-after",
+        type=float,
+        default=1,
+        help="the Retry-After seconds of a 429",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="seed of the failures and texts"
+    )
+    parser.add_argument(
+        "--reject-stream-options",
+        action="store_true",
+        help="fail requests with stream_options, like older servers",
+    )
+    parser.add_argument("--replay", metavar="file", help="answer from transcripts")
+    parser.add_argument(
+        "--record",
+        metavar="file",
+        help="forward the requests to --upstream and record the transcripts",
+    )
+    parser.add_argument(
+        "--upstream",
+        default="https://api.openai.com/v1",
+        help="the API to record, with the key in OPENAI_API_KEY",
+    )
+    parser.add_argument("--verbose", action="store_true", help="log the requests")
+    return parser
+
+
+def main(argv=None):
+    options = build_parser().parse_args(argv)
+    server = make_server(options, options.host, options.port)
+    print(
+        f"serving on http://{options.host}:{server.server_port}/v1",
+        file=sys.stderr,
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Timing spans of a run, reported with --profile on stderr or appended with
+--profile-file to a file, as a json object per run
+
+Spans are timed from when chatblade was imported, interpreter startup isn't
+included, and may nest (index is part of persist) or repeat. Recording does
+nothing unless enabled, so the instrumented code paths don't pay for it
+otherwise
+"""
+
+import atexit
+import contextlib
+import json
+import sys
+import threading
+import time
+
+# the start of the spans
+ORIGIN = time.perf_counter()
+
+_spans = None  # a list once enabled
+_totals = {}
+_lock = threading.Lock()
+_path = None
+
+
+def enable(path=None):
+    """record spans from now on, and report them at exit"""
+    global _spans, _path
+    if _spans is None:
+        _spans = []
+        _path = path
+        atexit.register(report)
+
+
+def enabled():
+    return _spans is not None
+
+
+def record(name, start, end=None, **fields):
+    """a span from start to end (now if left out), perf_counter times"""
+    if _spans is None:
+        return
+    end = time.perf_counter() if end is None else end
+    _spans.append(
+        {"name": name, "start": start - ORIGIN, "duration": end - start, **fields}
+    )
+
+
+@contextlib.contextmanager
+def span(name, **fields):
+    """a span of the block, fields can be added to the yielded dict"""
+    start = time.perf_counter()
+    try:
+        yield fields
+    finally:
+        record(name, start, **fields)
+
+
+def add(name, duration):
+    """add duration to the span name, which sums many short ones"""
+    if _spans is None:
+        return
+    with _lock:
+        if name not in _totals:
+            start = time.perf_counter() - duration - ORIGIN
+            _totals[name] = {"name": name, "start": start, "duration": 0, "calls": 0}
+            _spans.append(_totals[name])
+        _totals[name]["duration"] += duration
+        _totals[name]["calls"] += 1
+
+
+def timed(name, fn):
+    """fn, adding the time of each call to the span name when enabled"""
+    if _spans is None:
+        return fn
+
+    def timed_fn(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            add(name, time.perf_counter() - start)
+
+    return timed_fn
+
+
+def format_span(span):
+    fields = [
+        f"{k}={round(v, 1) if isinstance(v, float) else v}"
+        for k, v in span.items()
+        if k not in ("name", "start", "duration")
+    ]
+    times = f"{span['start'] * 1000:>8.1f}ms {span['duration'] * 1000:>9.1f}ms"
+    return f"  {span['name']:<14} {times}  {' '.join(fields)}".rstrip()
+
+
+def report():
+    """report the spans, to the path given to enable or else on stderr"""
+    spans = sorted(_spans, key=lambda span: span["start"])
+    total = time.perf_counter() - ORIGIN
+    spans.append({"name": "total", "start": 0, "duration": total})
+    if _path:
+        run = {"time": time.time(), "spans": spans}
+        with open(_path, "a") as f:
+            f.write(json.dumps(run) + "\n")
+    else:
+        header = f"  {'span':<14} {'start':>10} {'duration':>11}"
+        print("profile:", header, *map(format_span, spans), sep="\n", file=sys.stderr)
@@ -1,5 +1,3 @@
-from rich.pretty import pprint
-
 CONSOLE_DEBUG_LOGGING = False
 
 scratch_session = "last"
@@ -22,6 +20,8 @@ def merge_dicts(dict1, dict2):
 
 def debug(title=None, **kwargs):
     if CONSOLE_DEBUG_LOGGING:
+        from rich.pretty import pprint
+
         if title:
             pprint({f"{title}": kwargs})
         else: